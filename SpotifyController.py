@@ -1,15 +1,19 @@
 import tkinter as tk
 from tkinter import simpledialog
+from tkinter import font as tkfont
 from PIL import Image, ImageTk, ImageOps  # For handling images
-import keyboard
 import requests
 import webbrowser
 import ctypes
-import subprocess
 import os
 import threading
 import json
 import sys
+import time
+import profiling
+from hotkeys import HotkeyEngine, VOLUME_ACTIONS
+import resilience
+from controller_core import BackendSupervisor, ControllerCore, NO_TRACK_TEXT, TRACK_ERROR_TEXT
 
 # Determine the correct path for the config file
 if getattr(sys, 'frozen', False):
@@ -19,15 +23,21 @@ else:
     # If running as a script
     CONFIG_FILE = "config.json"
 
+# Run with --profile to collect a performance report (see profiling.py)
+PROFILE_MODE = profiling.profile_requested()
+if PROFILE_MODE:
+    profiling.enable("profile_controller.txt")
+
 # Create the main Tkinter window
 root = tk.Tk()
 root.title("Spotify Controller")
-root.geometry("450x300")
+root.geometry("450x340")
 root.resizable(False, False)
 
 # Set the background color of the root window
 root.configure(bg="#07003a")
 
+@profiling.timed("process_image")
 def process_image(image_path, target_color=None, invert_black=False):
     """
     Process an image to replace black pixels with a target color or invert black to white.
@@ -154,35 +164,83 @@ def check_credentials():
         prompt_for_credentials()
 
 
-# Start the backend server
-backend_process = subprocess.Popen(["python", "backend.py"], cwd=os.path.dirname(__file__))
+# Start the backend server, passing --profile through so both processes report
+BACKEND_COMMAND = ["python", "backend.py"] + (["--profile"] if PROFILE_MODE else [])
+backend = BackendSupervisor(BACKEND_COMMAND, cwd=os.path.dirname(__file__))
+try:
+    backend.start()
+    print("Backend server started successfully.")
+except Exception as e:
+    print(f"Error starting backend server: {e}")
+    sys.exit(1)
 
 # Ensure the backend process is terminated when the app exits
 import atexit
 @atexit.register
 def cleanup():
-    backend_process.terminate()
+    backend.stop()
 
-# Backend URL
-BACKEND_URL = "http://localhost:5000"
-access_token = None  # Global variable to store the access token
 token_error_shown = False  # Global flag to prevent multiple error dialogs
+BACKEND_STARTUP_TIMEOUT = 15  # Seconds to wait for a freshly started backend to answer
+BACKEND_STARTUP_RETRY = 0.25  # Seconds between attempts while it starts
+
+# Client state, polling and Spotify requests live in the UI-independent core
+core = ControllerCore()
+now_playing = core.now_playing
+
+def should_poll():
+    """Poll while logged in and the backend runs; once the backend is gone for good, show that instead of the last track."""
+    if token_error_shown:
+        return False
+    if backend.ensure_running():
+        return True
+    now_playing.update(track_text=TRACK_ERROR_TEXT, stale=True)  # The view-model skips this when nothing changed
+    return False
+
+# UI pump timing: fast cadence while changes are flowing, slow cadence when idle
+UI_FRAME_INTERVAL_MS = 33
+UI_IDLE_INTERVAL_MS = 200
+UI_FRAME_BUDGET = 0.008  # Seconds of widget work allowed per frame
+MARQUEE_FPS = 30  # Frame rate of the scrolling track title
+STALE_TRACK_FG = "#8c88b5"  # Dimmed title colour while Spotify is unreachable and the last known track is shown
+
+ui_renderers = {}  # Maps view-model field names to functions that apply them to widgets
+
+def pump_ui():
+    """Apply pending view-model changes to the widgets within the per-frame budget."""
+    deadline = time.perf_counter() + UI_FRAME_BUDGET
+    applied = 0
+    while time.perf_counter() < deadline:
+        change = now_playing.pop_change()
+        if change is None:
+            break
+        name, value = change
+        renderer = ui_renderers.get(name)
+        if renderer:
+            try:
+                renderer(value)
+            except Exception as e:
+                print(f"Error rendering {name}: {e}")
+        applied += 1
+
+    # Anything left over is picked up by the next frame
+    root.after(UI_FRAME_INTERVAL_MS if applied else UI_IDLE_INTERVAL_MS, pump_ui)
 
 # Default shortcuts
 shortcuts = {
     "skip": "ctrl+right",
     "previous": "ctrl+left",
     "volume_up": "ctrl+up",
-    "volume_down": "ctrl+down"
+    "volume_down": "ctrl+down",
+    "cycle_device": "ctrl+alt+d"
 }
 
 def load_shortcuts():
     """Load shortcuts from the configuration file."""
-    global shortcuts
     try:
         if os.path.exists(CONFIG_FILE):
             with open(CONFIG_FILE, "r") as file:
-                shortcuts = json.load(file)
+                shortcuts.update(json.load(file))  # Keep defaults for actions the file doesn't mention
                 print("Shortcuts loaded from config file.")
         else:
             print("Config file not found. Using default shortcuts.")
@@ -207,99 +265,70 @@ def send_media_key(key_code):
     ctypes.windll.user32.keybd_event(key_code, 0, 0, 0)  # Key down
     ctypes.windll.user32.keybd_event(key_code, 0, 2, 0)  # Key up
 # Functions for Spotify control
-def skip_track(track_label):
+def skip_track():
     """Simulate the 'Next Track' media key."""
     send_media_key(VK_MEDIA_NEXT_TRACK)
     print("Skipped to the next track.")
     
-    # Fetch the current track in a separate thread
-    threading.Thread(target=lambda: fetch_current_track(track_label), daemon=True).start()
+    # Wake the poller rather than starting a thread per press
+    core.request_refresh()
 
-def previous_track(track_label):
+def previous_track():
     """Simulate the 'Previous Track' media key."""
     send_media_key(VK_MEDIA_PREV_TRACK)
     print("Went back to the previous track.")
     
-    # Fetch the current track in a separate thread
-    threading.Thread(target=lambda: fetch_current_track(track_label), daemon=True).start()
-
-def volume_up(volume_slider):
-    """Increase the Spotify playback volume."""
-    def increase_volume():
-        global access_token
-        if not access_token:
-            print("You must log in first!")
-            return
-        try:
-            # Get the current volume
-            response = requests.get(f"https://api.spotify.com/v1/me/player", headers={
-                "Authorization": f"Bearer {access_token}"
-            })
-            if response.status_code != 200:
-                print(f"Error fetching current playback: {response.json().get('error', 'Unknown error')}")
-                return
-            current_volume = response.json().get("device", {}).get("volume_percent", 0)
-            new_volume = min(current_volume + 5, 100)  # Increase volume by 5%, max 100%
-            # Set the new volume
-            response = requests.put(f"https://api.spotify.com/v1/me/player/volume?volume_percent={new_volume}", headers={
-                "Authorization": f"Bearer {access_token}"
-            })
-            if response.status_code == 204:
-                print(f"Spotify volume increased to {new_volume}%.")
-                volume_slider.set(new_volume)  # Update the slider position
-            else:
-                print(f"Error setting volume: {response.json().get('error', 'Unknown error')}")
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
-
-    # Run the volume adjustment in a separate thread
-    threading.Thread(target=increase_volume, daemon=True).start()
-
-def volume_down(volume_slider):
-    """Decrease the Spotify playback volume."""
-    def decrease_volume():
-        global access_token
-        if not access_token:
-            print("You must log in first!")
-            return
-        try:
-            # Get the current volume
-            response = requests.get(f"https://api.spotify.com/v1/me/player", headers={
-                "Authorization": f"Bearer {access_token}"
-            })
-            if response.status_code != 200:
-                print(f"Error fetching current playback: {response.json().get('error', 'Unknown error')}")
-                return
-            current_volume = response.json().get("device", {}).get("volume_percent", 0)
-            new_volume = max(current_volume - 5, 0)  # Decrease volume by 5%, min 0%
-            # Set the new volume
-            response = requests.put(f"https://api.spotify.com/v1/me/player/volume?volume_percent={new_volume}", headers={
-                "Authorization": f"Bearer {access_token}"
-            })
-            if response.status_code == 204:
-                print(f"Spotify volume decreased to {new_volume}%.")
-                volume_slider.set(new_volume)  # Update the slider position
-            else:
-                print(f"Error setting volume: {response.json().get('error', 'Unknown error')}")
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
+    # Wake the poller rather than starting a thread per press
+    core.request_refresh()
+
+def cycle_device():
+    """Move playback to the next Spotify device."""
+    threading.Thread(target=core.cycle_device, daemon=True).start()
+
+def show_hotkey_latency():
+    """Show how long hotkey presses took to reach the dispatcher."""
+    summary = hotkey_engine.latency_summary()
+    if summary is None:
+        tk.messagebox.showinfo("Hotkey Latency", "No hotkeys have been pressed yet.")
+        return
+    tk.messagebox.showinfo("Hotkey Latency", (
+        f"Press-to-dispatch latency over the last {summary['presses']} presses:\n"
+        f"mean {summary['mean']:.2f} ms, p95 {summary['p95']:.2f} ms, max {summary['max']:.2f} ms"
+    ))
+
+def select_device(device_id):
+    """Move playback to the device picked in the device menu."""
+    if device_id != now_playing.get("active_device"):
+        threading.Thread(target=core.transfer_playback, args=(device_id,), daemon=True).start()
+
+def queue_items():
+    """Ask for tracks, albums or playlists and add them all to the playback queue."""
+    text = simpledialog.askstring("Queue Tracks", "Spotify URIs or links of tracks, albums or playlists, separated by spaces:")
+    if not text or not text.split():
+        return
 
-    # Run the volume adjustment in a separate thread
-    threading.Thread(target=decrease_volume, daemon=True).start()
+    def show_report(report):
+        if report is None:
+            tk.messagebox.showerror("Error", "Could not reach the backend to queue the items.")
+        elif report["failed"]:
+            failed = [f"{result['uri']}: {result['error']}" for result in report["results"] if not result["ok"]]
+            failures = "\n".join(failed[:10])  # Keep the dialog a sensible size
+            tk.messagebox.showwarning("Queue Tracks", f"Queued {report['queued']} items, {report['failed']} failed:\n{failures}")
+        else:
+            tk.messagebox.showinfo("Queue Tracks", f"Queued {report['queued']} items.")
+
+    # Queue in the background and report back on the main thread
+    def run():
+        report = core.enqueue(text.split())
+        root.after(0, lambda: show_report(report))
+    threading.Thread(target=run, daemon=True).start()
 
 # Define the open_main_ui function here
 def open_main_ui():
     global btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_main_inverted, door_icon_main
-    try:
-        backend_process = subprocess.Popen(["python", "backend.py"], cwd=os.path.dirname(__file__))
-        print("Backend server started successfully.")
-    except Exception as e:
-        print(f"Error starting backend server: {e}")
-        sys.exit(1)
-    
     global root  # Reuse the existing root instance
     root.title("Spotify Controller")
-    root.geometry("450x300")
+    root.geometry("450x340")
     root.resizable(False, False)
 
     # Set the background color of the root window
@@ -314,26 +343,31 @@ def open_main_ui():
     menu.add_command(label="Change Previous Shortcut", command=lambda: change_shortcut("previous"))
     menu.add_command(label="Change Volume Up Shortcut", command=lambda: change_shortcut("volume_up"))
     menu.add_command(label="Change Volume Down Shortcut", command=lambda: change_shortcut("volume_down"))
+    menu.add_command(label="Change Cycle Device Shortcut", command=lambda: change_shortcut("cycle_device"))
+    menu.add_separator()
+    menu.add_command(label="Queue Tracks...", command=queue_items)
+    menu.add_command(label="Hotkey Latency", command=show_hotkey_latency)
     menu_bar.add_cascade(label="Menu", menu=menu)
 
     # Configure the menu bar
     root.config(menu=menu_bar)
 
     # Current track label
-    track_label = tk.Label(root, text="No track is currently playing.", font=("Arial", 14), fg="white", bg="#07003a")
+    track_label = MarqueeLabel(root, width=410, font=("Arial", 14), fps=MARQUEE_FPS)
     track_label.pack(pady=35)
+    track_label.set_text(NO_TRACK_TEXT)
 
     # Buttons for playback control
-    btn_skip = tk.Button(root, text="Skip Track", command=lambda: skip_track(track_label), width=20, bg="#0a004d", fg="white", bd=0)
+    btn_skip = tk.Button(root, text="Skip Track", command=skip_track, width=20, bg="#0a004d", fg="white", bd=0)
     btn_skip.pack(pady=5)
 
-    btn_previous = tk.Button(root, text="Previous Track", command=lambda: previous_track(track_label), width=20, bg="#0a004d", fg="white", bd=0)
+    btn_previous = tk.Button(root, text="Previous Track", command=previous_track, width=20, bg="#0a004d", fg="white", bd=0)
     btn_previous.pack(pady=5)
 
-    btn_volume_up = tk.Button(root, text="Volume Up", command=lambda: volume_up(volume_slider), width=20, bg="#0a004d", fg="white", bd=0)
+    btn_volume_up = tk.Button(root, text="Volume Up", command=lambda: hotkey_engine.press("volume_up"), width=20, bg="#0a004d", fg="white", bd=0)
     btn_volume_up.pack(pady=5)
 
-    btn_volume_down = tk.Button(root, text="Volume Down", command=lambda: volume_down(volume_slider), width=20, bg="#0a004d", fg="white", bd=0)
+    btn_volume_down = tk.Button(root, text="Volume Down", command=lambda: hotkey_engine.press("volume_down"), width=20, bg="#0a004d", fg="white", bd=0)
     btn_volume_down.pack(pady=5)
 
     # Reinitialize the door icons
@@ -349,7 +383,7 @@ def open_main_ui():
     btn_login = tk.Button(
         root,
         image=door_icon_main,
-        command=lambda: login_to_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, track_label, door_icon_main_inverted),
+        command=lambda: login_to_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_main_inverted),
         width=40,
         height=40,
         bd=0,
@@ -360,21 +394,10 @@ def open_main_ui():
     # Volume slider
     def set_volume(value):
         """Set the Spotify playback volume based on the slider value."""
-        global access_token
-        if not access_token:
-            print("You must log in first!")
-            return
-        try:
-            volume = int(value)  # Convert slider value to integer
-            response = requests.put(f"https://api.spotify.com/v1/me/player/volume?volume_percent={volume}", headers={
-                "Authorization": f"Bearer {access_token}"
-            })
-            if response.status_code == 204:
-                print(f"Spotify volume set to {volume}%.")
-            else:
-                print(f"Error setting volume: {response.json().get('error', 'Unknown error')}")
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
+        volume = int(value)  # Convert slider value to integer
+        if volume == now_playing.get("volume"):
+            return  # The slider was moved by the UI pump to mirror Spotify, nothing to send
+        core.request_volume(volume)  # Sent off the Tk thread; only the latest value of a drag goes out
 
     volume_slider = tk.Scale(
         root,
@@ -390,33 +413,53 @@ def open_main_ui():
     )
     volume_slider.pack(pady=5)
 
-    def fetch_current_volume():
-        """Fetch the current Spotify playback volume and update the slider."""
-        global access_token
-        if not access_token:
-            print("You must log in first!")
-            return
-        try:
-            response = requests.get(f"https://api.spotify.com/v1/me/player", headers={
-                "Authorization": f"Bearer {access_token}"
-            })
-            if response.status_code == 200:
-                current_volume = response.json().get("device", {}).get("volume_percent", 0)
-                volume_slider.set(current_volume)  # Set the slider to the current volume
-                print(f"Current Spotify volume: {current_volume}%.")
-            else:
-                print(f"Error fetching current volume: {response.json().get('error', 'Unknown error')}")
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
-
-    # Fetch the current volume on startup
-    fetch_current_volume()
-
-    # Check token status on startup
-    check_token_status(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, track_label, door_icon_main_inverted, door_icon_main)
+    # Device picker, filled from the device list the backend keeps cached
+    device_name = tk.StringVar(value="No device")
+    device_picker = tk.OptionMenu(root, device_name, "No device")
+    device_picker.config(width=30, bg="#0a004d", fg="white", activebackground="#0a004d", activeforeground="white", bd=0, highlightthickness=0)
+    device_picker.pack(pady=5)
+
+    def render_devices(devices):
+        """Rebuild the picker's menu from the (id, name) device pairs."""
+        device_menu = device_picker["menu"]
+        device_menu.delete(0, "end")
+        for device_id, name in devices:
+            device_menu.add_command(label=name, command=lambda device_id=device_id: select_device(device_id))
+        render_active_device(now_playing.get("active_device"))
+
+    def render_active_device(active_device):
+        names = dict(now_playing.get("devices"))
+        device_name.set(names.get(active_device, "No device"))
+
+    # Widgets are only ever touched by the UI pump, which runs on the Tk thread
+    ui_renderers["track_text"] = track_label.set_text
+    ui_renderers["stale"] = lambda stale: track_label.set_fg(STALE_TRACK_FG if stale else "white")
+    ui_renderers["volume"] = lambda volume: volume_slider.set(volume) if volume is not None else None
+    ui_renderers["devices"] = render_devices
+    ui_renderers["active_device"] = render_active_device
+    pump_ui()
+
+    # Pick up a token cached by an earlier launch as soon as the backend, still starting up, answers
+    def wait_for_token_status():
+        deadline = time.monotonic() + BACKEND_STARTUP_TIMEOUT
+        status = core.check_token_status()
+        while status is None and time.monotonic() < deadline:
+            time.sleep(BACKEND_STARTUP_RETRY)
+            status = core.check_token_status()
+        if status == 200:
+            core.fetch_current_volume()
+            core.request_refresh()
+        root.after(0, lambda: apply_token_status(
+            status, btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_main_inverted, door_icon_main
+        ))
+    threading.Thread(target=wait_for_token_status, daemon=True).start()
     
-    # Start periodic track fetching
-    periodic_fetch_current_track(track_label)
+    # Start periodic track fetching on the core's poller thread
+    core.on_token_expired = lambda: root.after(0, lambda: check_token_status(
+        btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_main_inverted, door_icon_main
+    ))  # Token handling updates widgets, so it runs on the main thread
+    core.should_poll = should_poll
+    core.start_polling()
 
     # Run the main UI
     root.mainloop()
@@ -464,14 +507,9 @@ def change_shortcut(action):
         """Confirm the shortcut and close the dialog."""
         new_shortcut = "+".join(keys_pressed)
         if new_shortcut:
-            # Remove the old shortcut
-            if action in shortcuts:
-                old_shortcut = shortcuts[action]
-                keyboard.remove_hotkey(old_shortcut)
-
-            # Add the new shortcut
+            # Replace the old shortcut
             shortcuts[action] = new_shortcut
-            keyboard.add_hotkey(new_shortcut, actions[action])
+            hotkey_engine.bind(action, new_shortcut)
             print(f"Shortcut for {action} changed to {new_shortcut}.")
             save_shortcuts()  # Save the updated shortcuts to the config file
         else:
@@ -501,61 +539,69 @@ def change_shortcut(action):
     # Wait for the dialog to close
     dialog.wait_window()
 
-def check_token_status(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, track_label, door_icon_main_inverted, door_icon_main):
+def check_token_status(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_main_inverted, door_icon_main):
     """Check the token status and refresh it if necessary."""
-    global access_token, token_error_shown
-    try:
-        response = requests.get(f"{BACKEND_URL}/token_status")
-        if response.status_code == 200:
-            token_data = response.json()
-            access_token = token_data.get("access_token")  # Update the global access_token
-            print("Access token is valid.")
-            # Change the button to the logout state
-            btn_login.config(image=door_icon_inverted, command=lambda: logout_of_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, track_label, door_icon_inverted))
-            token_error_shown = False  # Reset the flag when the token is valid
-        elif response.status_code == 401:
-            print("Access token expired or invalid. Please log in again.")
-            if not token_error_shown:  # Show the error dialog only once
-                token_error_shown = True
-                tk.messagebox.showerror("Error", "Access token expired. Please log in again.")
-                btn_login.config(command=lambda: login_to_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, track_label, door_icon_main_inverted))
-        else:
-            print(f"Unexpected error: {response.json().get('error', 'Unknown error')}")
-    except Exception as e:
-        print(f"Error checking token status: {e}")
+    status = core.check_token_status()
+    apply_token_status(status, btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_main_inverted, door_icon_main)
 
-def login_to_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, track_label, door_icon_inverted):
-    """Log in to Spotify and fetch the access token."""
+def apply_token_status(status, btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_main_inverted, door_icon_main):
+    """Update the login button for a token status from the backend."""
     global token_error_shown
-    response = requests.get(f"{BACKEND_URL}/login")
-    auth_url = response.json().get("auth_url")
+    if status == 200:
+        # Change the button to the logout state
+        btn_login.config(image=door_icon_inverted, command=lambda: logout_of_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_inverted))
+        token_error_shown = False  # Reset the flag when the token is valid
+    elif status == 401:
+        if not token_error_shown:  # Show the error dialog only once
+            token_error_shown = True
+            tk.messagebox.showerror("Error", "Access token expired. Please log in again.")
+            btn_login.config(command=lambda: login_to_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_main_inverted))
+
+def login_to_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_inverted):
+    """Log in to Spotify and pick up the access token as soon as the browser login completes."""
+    try:
+        response = requests.get(f"{core.backend_url}/login", timeout=resilience.deadline("backend"))
+        auth_url = response.json().get("auth_url")
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Error starting login: {e}")
+        tk.messagebox.showerror("Error", "Could not reach the backend to log in.")
+        return
     webbrowser.open(auth_url)
     print("Opened Spotify login page in the browser.")
-    
-    # Enable playback control buttons
-    btn_skip.config(state=tk.NORMAL)
-    btn_previous.config(state=tk.NORMAL)
-    btn_volume_up.config(state=tk.NORMAL)
-    btn_volume_down.config(state=tk.NORMAL)
 
-    # Change the button to the logout state
-    btn_login.config(image=door_icon_inverted, command=lambda: logout_of_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, track_label, door_icon_inverted))
+    def finish_login(logged_in):
+        global token_error_shown
+        if not logged_in:
+            tk.messagebox.showerror("Error", "Spotify login did not complete. Please try again.")
+            return
+
+        # Enable playback control buttons
+        btn_skip.config(state=tk.NORMAL)
+        btn_previous.config(state=tk.NORMAL)
+        btn_volume_up.config(state=tk.NORMAL)
+        btn_volume_down.config(state=tk.NORMAL)
+
+        # Change the button to the logout state
+        btn_login.config(image=door_icon_inverted, command=lambda: logout_of_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_inverted))
+        token_error_shown = False  # Reset the flag after successful login
+        core.request_refresh()  # Fetch the current track with the new token
 
-    fetch_access_token(callback=fetch_current_track(track_label))  # Fetch the access token and then fetch the current track
-    check_token_status(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, track_label, door_icon_main_inverted, door_icon_main)
-    token_error_shown = False  # Reset the flag after successful login
+    # The backend answers /wait_login the moment /callback has the token; wait off the main thread
+    def wait():
+        logged_in = core.wait_for_login()
+        root.after(0, lambda: finish_login(logged_in))
+    threading.Thread(target=wait, daemon=True).start()
 
-def logout_of_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, track_label, door_icon_normal):
+def logout_of_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_normal):
     """Log out of Spotify by clearing the cached access token and disabling controls."""
-    global access_token
-    access_token = None  # Clear the access token
+    core.logout()  # Clear the access token and the backend's token cache
     print("Logged out of Spotify. Access token cleared.")
     
     # Update the login button
-    btn_login.config(image=door_icon_normal, command=lambda: login_to_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, track_label, door_icon_normal))
+    btn_login.config(image=door_icon_normal, command=lambda: login_to_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, door_icon_normal))
     
     # Reset the track label
-    track_label.config(text="No track is currently playing.")
+    now_playing.update(track_text=NO_TRACK_TEXT, stale=False)
     
     # Disable playback control buttons
     btn_skip.config(state=tk.DISABLED)
@@ -563,114 +609,84 @@ def logout_of_spotify(btn_login, btn_skip, btn_previous, btn_volume_up, btn_volu
     btn_volume_up.config(state=tk.DISABLED)
     btn_volume_down.config(state=tk.DISABLED)
 
-def fetch_access_token(callback=None):
-    """Fetch the access token from the backend and execute a callback if provided."""
-    global access_token
-    try:
-        response = requests.get(f"{BACKEND_URL}/token")
-        if response.status_code == 200:
-            access_token = response.json().get("access_token")
-            print("Access token fetched successfully.")
-            if callback:
-                callback()  # Execute the callback function (e.g., fetch_current_track)
-        else:
-            print("Failed to fetch access token.")
-    except Exception as e:
-        print(f"Error fetching access token: {e}")
-
-def fetch_current_track(track_label):
-    """Fetch the currently playing track."""
-    global access_token
-    if not access_token:
-        print("You must log in first!")
-        return
-    try:
-        print("Fetching current track...")
-        response = requests.get(f"{BACKEND_URL}/current_track", params={"token": access_token})
-        if response.status_code == 401:  # Token expired
-            print("Access token expired. Refreshing token...")
-            check_token_status(
-                btn_login, btn_skip, btn_previous, btn_volume_up, btn_volume_down, track_label, door_icon_main_inverted, door_icon_main
-            )
-            root.after(0, lambda: fetch_current_track(track_label))  # Retry the request on the main thread
+class MarqueeLabel(tk.Canvas):
+    """
+    Single-line text display that scrolls its text when it is wider than the widget.
+    The text is measured once with the real font metrics and drawn once as Canvas text
+    items; each frame only moves those items, so animating allocates next to nothing.
+    """
+    def __init__(self, parent, width, font=("Arial", 14), fg="white", bg="#07003a", fps=30, speed=40, gap=60):
+        self._font = tkfont.Font(root=parent, font=font)
+        super().__init__(parent, width=width, height=self._font.metrics("linespace"), bg=bg, bd=0, highlightthickness=0)
+        self._width = width
+        self._fg = fg
+        self._interval = max(1, round(1000 / fps))  # Milliseconds per frame
+        self._step = speed * self._interval / 1000  # Pixels per frame, unrounded: Canvas moves take fractions, so fps only changes smoothness
+        self._gap = gap  # Pixels between the end of the text and its repeat
+        self._text = None
+        self._span = 0  # Distance after which the scroll loop repeats, 0 when the text fits
+        self._offset = 0
+        self._job = None
+        self._hidden = False
+
+        # Stop animating while the window is minimized or withdrawn
+        toplevel = self.winfo_toplevel()
+        toplevel.bind("<Unmap>", lambda event: self._set_hidden(event, True), add="+")
+        toplevel.bind("<Map>", lambda event: self._set_hidden(event, False), add="+")
+
+    def set_text(self, text):
+        """Display new text, scrolling it only if its rendered width exceeds the widget."""
+        if text == self._text:
             return
-        if response.status_code != 200:
-            print(f"Error fetching current track: {response.json().get('error', 'Unknown error')}")
-            root.after(0, lambda: track_label.config(text="Error fetching current track."))  # Update UI on the main thread
+        self._text = text
+        self._stop()
+        self.delete("all")
+
+        y = self.winfo_reqheight() // 2
+        text_width = self._font.measure(text)
+        if text_width <= self._width:
+            self._span = 0
+            self.create_text(self._width // 2, y, text=text, font=self._font, fill=self._fg, anchor="center")
             return
-        current_track = response.json()
-        if current_track and current_track.get("item"):
-            track_name = current_track["item"]["name"]
-            artist_name = current_track["item"]["artists"][0]["name"]
-            full_text = f"Now Playing: {artist_name} - {track_name}"
-            root.after(0, lambda: track_label.config(text=full_text))  # Update UI on the main thread
-        else:
-            root.after(0, lambda: track_label.config(text="No track is currently playing."))  # Update UI on the main thread
-    except requests.exceptions.RequestException as e:
-        print(f"Request failed: {e}")
-        root.after(0, lambda: track_label.config(text="Error fetching current track."))  # Update UI on the main thread
-
-def periodic_fetch_current_track(track_label):
-    """Fetch the current track periodically without consuming too many resources."""
-    def fetch_in_thread():
-        try:
-            # Pass all required arguments to fetch_current_track
-            fetch_current_track(track_label)
-        except Exception as e:
-            print(f"Error during periodic fetch: {e}")
-    
-    # Run the fetch in a separate thread to avoid blocking the UI
-    if backend_process.poll() is None:  # Check if the backend process is still running
-        if not token_error_shown:  # Stop periodic fetch if token error is shown
-            threading.Thread(target=fetch_in_thread, daemon=True).start()
-            # Schedule the function to run again after 3 seconds
-            root.after(3000, lambda: periodic_fetch_current_track(track_label))
-        else:
-            print("Token error detected. Stopping periodic fetch.")
-    else:
-        print("Backend server is not running. Stopping periodic fetch.")
 
-scrolling_job = None  # Global variable to track the current scrolling job
-current_scrolling_text = None  # Global variable to track the currently scrolling text
+        # Two copies one span apart make the loop seamless
+        self._span = text_width + self._gap
+        self._offset = 0
+        for x in (0, self._span):
+            self.create_text(x, y, text=text, font=self._font, fill=self._fg, anchor="w", tags="marquee")
+        self._start()
 
-def scroll_track_label(text, label, delay=150):
-    """
-    Scroll the text in the label from left to right after "Now Playing:" if it's too long.
-    """
-    global scrolling_job, current_scrolling_text
-    static_text = "Now Playing: "  # Static part of the text
+    def set_fg(self, fg):
+        """Change the text colour without redrawing the text."""
+        self._fg = fg
+        self.itemconfigure("all", fill=fg)
 
-    # If the text hasn't changed, do nothing
-    if current_scrolling_text == text:
-        return
-
-    # Update the current scrolling text
-    current_scrolling_text = text
-
-    # Cancel any existing scrolling job
-    if scrolling_job is not None:
-        label.after_cancel(scrolling_job)
-        scrolling_job = None
-
-    # Check if the text is longer than the label width
-    if len(text) > 30:
-        dynamic_text = text[len(static_text):] + "   "  # Add spacing for smooth scrolling
-
-        def scroll():
-            global scrolling_job
-            nonlocal dynamic_text
-            # Move the first character to the end
-            dynamic_text = dynamic_text[1:] + dynamic_text[0]
-            # Update the label with the static and scrolling parts
-            label.config(text=static_text + dynamic_text[:30])
-            # Schedule the next scroll
-            scrolling_job = label.after(delay, scroll)
-
-        # Start the scrolling loop
-        scroll()
-    else:
-        # If the text fits, display it as is
-        label.config(text=text)
+    def _set_hidden(self, event, hidden):
+        if event.widget is not self.winfo_toplevel():
+            return
+        self._hidden = hidden
+        if hidden:
+            self._stop()
+        else:
+            self._start()
+
+    def _start(self):
+        if self._job is None and self._span and not self._hidden:
+            self._job = self.after(self._interval, self._tick)
+
+    def _stop(self):
+        if self._job is not None:
+            self.after_cancel(self._job)
+            self._job = None
+
+    def _tick(self):
+        self.move("marquee", -self._step, 0)
+        self._offset += self._step
+        if self._offset >= self._span:
+            # The second copy now sits where the first one started, so jump back a full span
+            self.move("marquee", self._span, 0)
+            self._offset -= self._span
+        self._job = self.after(self._interval, self._tick)
 
 def prompt_for_credentials():
     """Prompt the user to input their Spotify Developer credentials."""
@@ -687,6 +703,21 @@ def prompt_for_credentials():
     return credentials
 
 
+# Map actions to functions; the volume actions are ramped by the hotkey engine instead
+actions = {
+    "skip": skip_track,
+    "previous": previous_track,
+    "cycle_device": cycle_device
+}
+hotkey_engine = HotkeyEngine(actions, VOLUME_ACTIONS, core.change_volume)
+
+# Load shortcuts from the config file
+load_shortcuts()
+
+# Bind shortcuts before the main UI starts its event loop
+for action, shortcut in shortcuts.items():
+    hotkey_engine.bind(action, shortcut)
+
 # Check if credentials.json exists
 if not os.path.exists("credentials.json"):
     print("Spotify credentials not found. Prompting user for input...")
@@ -711,19 +742,4 @@ else:
         print("Error reading credentials.json. Prompting user for input...")
         open_setup_guide()
 
-# Map actions to functions
-actions = {
-    "skip": skip_track,
-    "previous": previous_track,
-    "volume_up": volume_up,
-    "volume_down": volume_down
-}
-
-# Load shortcuts from the config file
-load_shortcuts()
-
-# Bind shortcuts
-for action, shortcut in shortcuts.items():
-    keyboard.add_hotkey(shortcut, actions[action])
-
 root.mainloop()
\ No newline at end of file
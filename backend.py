@@ -1,9 +1,18 @@
 import os
 import logging
 import json
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
 from flask import Flask, request, jsonify, redirect, render_template_string
 from spotipy.oauth2 import SpotifyOAuth
 import spotipy
+import profiling
+import resilience
+from token_cache import WriteBehindCacheHandler
 
 # Suppress Flask's default logging
 log = logging.getLogger('werkzeug')
@@ -11,6 +20,10 @@ log.setLevel(logging.ERROR)
 
 app = Flask(__name__)
 
+# Run with --profile to collect a performance report (see profiling.py)
+if profiling.profile_requested():
+    profiling.enable("profile_backend.txt")
+
 # Load Spotify API credentials from credentials.json
 CREDENTIALS_FILE = "credentials.json"
 
@@ -30,24 +43,247 @@ except KeyError as e:
 # Scopes for controlling playback
 SCOPE = "user-read-playback-state user-modify-playback-state"
 
-# Spotify OAuth object
+# Spotify endpoints, overridable so soak.py can point the backend at a local fake API
+SPOTIFY_API_URL = os.environ.get("SPOTIFY_API_URL", "https://api.spotify.com/v1/")
+SPOTIFY_ACCOUNTS_URL = os.environ.get("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+
+# Spotify OAuth object, with the token kept in memory and written to disk in the background
+token_cache = WriteBehindCacheHandler()
 sp_oauth = SpotifyOAuth(client_id=CLIENT_ID,
                         client_secret=CLIENT_SECRET,
                         redirect_uri=REDIRECT_URI,
-                        scope=SCOPE)
+                        scope=SCOPE,
+                        cache_handler=token_cache,
+                        requests_timeout=resilience.deadline("token"))
+sp_oauth.OAUTH_AUTHORIZE_URL = f"{SPOTIFY_ACCOUNTS_URL}/authorize"
+sp_oauth.OAUTH_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+def shut_down(signum, frame):
+    """Flush the token cache and exit on SIGTERM, which the controller sends on close and which skips atexit."""
+    token_cache.flush()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, shut_down)
+
+# spotipy refreshes expired tokens inside get_cached_token, so time the refresh itself
+sp_oauth.refresh_access_token = profiling.timed("token_refresh")(sp_oauth.refresh_access_token)
+
+# Hedge slow /me/player reads with a backup request after the recent p95 latency
+HEDGE_PLAYBACK_READS = os.environ.get("SPOTIFY_HEDGE_READS", "1") == "1"
+
+def is_upstream_failure(error):
+    """Return True for errors that mean Spotify itself is slow or unhealthy, rather than our request being refused."""
+    if isinstance(error, spotipy.exceptions.SpotifyException):
+        return error.http_status == 429 or error.http_status >= 500
+    return isinstance(error, (requests.exceptions.RequestException, resilience.CircuitOpenError, resilience.DeadlineExceeded))
+
+playback_breaker = resilience.CircuitBreaker("Spotify playback", is_failure=is_upstream_failure)
+playback_latency = resilience.LatencyTracker()
+hedge_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hedge")
+last_playback = None  # Last playback state Spotify returned, served as stale while it is unhealthy
+
+# Shared by every Spotify client so connections are reused. A plain session never retries: retries would
+# stretch the deadlines, and the circuit breaker handles repeated failures. It also hands 429s back with their
+# headers, whereas spotipy's own retrying session turns them into a SpotifyException without Retry-After.
+upstream_session = requests.Session()
+
+def spotify_client(token, endpoint):
+    """Create a Spotify API client for the given access token, with the endpoint's deadline."""
+    sp = spotipy.Spotify(auth=token, requests_session=upstream_session, requests_timeout=resilience.deadline(endpoint))
+    sp.prefix = SPOTIFY_API_URL
+    return sp
+
+# Device list, refreshed in the background so listing or switching devices needs no upstream round trip
+DEVICE_REFRESH_INTERVAL = 30  # Seconds
+device_cache = []
+device_cache_lock = threading.Lock()
+device_cache_loaded = threading.Event()
+token_lock = threading.Lock()  # Concurrent callers share one refresh instead of each refreshing
+
+def cached_token_info():
+    """Return the cached token info (refreshed if it expired), or None when not logged in. Read tokens only through this."""
+    with token_lock:
+        return sp_oauth.get_cached_token()
+
+def cached_access_token():
+    """Return the cached access token (refreshed if it expired), or None when not logged in."""
+    token_info = cached_token_info()
+    return token_info['access_token'] if token_info else None
+
+def device_summary(device):
+    """Keep only the device fields the controller uses."""
+    return {key: device.get(key) for key in ("id", "name", "type", "is_active", "volume_percent")}
+
+def refresh_devices():
+    """Fetch the device list from Spotify into the cache."""
+    global device_cache
+    token = cached_access_token()
+    if not token:
+        device_cache_loaded.set()  # Nothing to list until the user logs in
+        return
+    devices = spotify_client(token, "devices").devices().get("devices", [])
+    with device_cache_lock:
+        device_cache = [device_summary(device) for device in devices]
+    device_cache_loaded.set()
+
+def device_refresher():
+    while True:
+        try:
+            refresh_devices()
+        except Exception as e:
+            print(f"Error refreshing devices: {e}")
+        time.sleep(DEVICE_REFRESH_INTERVAL)
+
+def start_device_refresher():
+    """Start the background thread that keeps the device cache current."""
+    threading.Thread(target=device_refresher, name="device-refresher", daemon=True).start()
+
+# Bulk queueing: per-item /me/player/queue calls fan out over a bounded worker pool
+QUEUE_WORKERS = 4  # Upstream calls in flight at once
+QUEUE_MAX_ATTEMPTS = 3  # Tries per item before it is reported as failed
+queue_pool = ThreadPoolExecutor(max_workers=QUEUE_WORKERS, thread_name_prefix="queue")
+
+def parse_spotify_uri(item):
+    """Split a spotify:type:id URI or an open.spotify.com link into (type, id)."""
+    item = item.strip()
+    if item.startswith("spotify:"):
+        parts = item.split(":")
+        if len(parts) == 3:
+            return parts[1], parts[2]
+    elif "open.spotify.com/" in item:
+        parts = item.split("open.spotify.com/", 1)[1].split("?")[0].strip("/").split("/")
+        if parts and parts[0].startswith("intl-"):
+            parts = parts[1:]  # Localized links look like open.spotify.com/intl-de/track/...
+        if len(parts) >= 2:
+            return parts[0], parts[1]
+    raise ValueError(f"Not a Spotify URI or link: {item}")
+
+def expand_queue_item(sp, item):
+    """Return the track URIs an item stands for: itself for a track or episode, every track for an album or playlist."""
+    kind, item_id = parse_spotify_uri(item)
+    if kind in ("track", "episode"):
+        return [f"spotify:{kind}:{item_id}"]
+    if kind == "album":
+        page = sp.album_tracks(item_id, limit=50)
+    elif kind == "playlist":
+        page = sp.playlist_items(item_id, fields="items(track(uri)),next", limit=100)
+    else:
+        raise ValueError(f"Can't queue a {kind}: {item}")
+
+    uris = []
+    while page:
+        for entry in page["items"]:
+            track = entry.get("track", entry) if kind == "playlist" else entry
+            if track and track.get("uri"):
+                uris.append(track["uri"])
+        page = sp.next(page) if page.get("next") else None
+    return uris
+
+def retry_after(error):
+    """Return the seconds a 429 asked us to wait, from its Retry-After header."""
+    try:
+        return max(float((error.headers or {}).get("Retry-After", 1)), 0)
+    except ValueError:
+        return 1
+
+def queue_uri(uri, gate):
+    """
+    Add one URI to the queue, backing off together with the other workers when rate limited. Returns an error message or None.
+    Adding to the queue isn't idempotent, so only calls Spotify can't have applied are retried: 429s and failures to connect.
+    """
+    error = None
+    for attempt in range(QUEUE_MAX_ATTEMPTS):
+        gate.wait()
+        token = cached_access_token()  # Read per call so a long bulk request outlives the token it started with
+        if not token:
+            return "Access token is missing or expired"
+        try:
+            spotify_client(token, "queue").add_to_queue(uri)
+            return None
+        except spotipy.exceptions.SpotifyException as e:
+            if e.http_status != 429:
+                return f"{e.msg} (may have been queued)" if e.http_status >= 500 else e.msg
+            error = e.msg
+            gate.pause(retry_after(e))
+        except requests.exceptions.ConnectionError as e:
+            error = str(e)  # Covers ConnectTimeout; the request never reached Spotify
+        except requests.exceptions.RequestException as e:
+            return f"{e} (may have been queued)"  # E.g. a read timeout: Spotify may have applied it
+    return error
+
+def enqueue_items(token, items, ordered=True):
+    """
+    Queue tracks, albums and playlists, returning one result per queued URI in input order.
+    Albums and playlists are expanded in parallel. Spotify appends in arrival order, so by
+    default the per-track calls are then sent one at a time to keep the playback queue in
+    input order; ordered=False sends them with up to QUEUE_WORKERS in flight, and
+    neighbouring tracks can swap places.
+    """
+    sp = spotify_client(token, "queue")
+    expansions = [queue_pool.submit(expand_queue_item, sp, item) for item in items]
+    results = []
+    for item, expansion in zip(items, expansions):
+        try:
+            results += [{"uri": uri, "ok": True, "error": None} for uri in expansion.result()]
+        except Exception as e:
+            results.append({"uri": item, "ok": False, "error": getattr(e, "msg", None) or str(e)})
+
+    gate = resilience.RateLimitGate()
+    to_queue = [result for result in results if result["ok"]]
+    if ordered:
+        for result in to_queue:
+            result["error"] = queue_uri(result["uri"], gate)
+    else:
+        futures = [queue_pool.submit(queue_uri, result["uri"], gate) for result in to_queue]
+        for result, future in zip(to_queue, futures):
+            result["error"] = future.result()
+    for result in to_queue:
+        result["ok"] = result["error"] is None
+    return results
+
+def read_playback(token):
+    """Fetch the current playback state, hedged if enabled."""
+    sp = spotify_client(token, "player")
+    if HEDGE_PLAYBACK_READS:
+        return resilience.hedged_call(sp.current_playback, playback_latency, hedge_pool, resilience.deadline("player"))
+    return sp.current_playback()
+
+# Login completion, set by /callback for clients blocked on /wait_login
+login_complete = threading.Event()
+login_error = None
 
 @app.route('/login', methods=['GET'])
 def login():
     """Redirect the user to Spotify's login page."""
+    global login_error
+    login_complete.clear()
+    login_error = None
     auth_url = sp_oauth.get_authorize_url()
     return jsonify({"auth_url": auth_url})
 
 @app.route('/callback', methods=['GET'])
 def callback():
     """Handle the redirect from Spotify and fetch the access token."""
+    global login_error
     code = request.args.get('code')
-    token_info = sp_oauth.get_access_token(code)
+    try:
+        if not code:
+            raise spotipy.oauth2.SpotifyOauthError(request.args.get('error', "No authorization code received"))
+        sp_oauth.get_access_token(code, as_dict=False, check_cache=False)
+    except (spotipy.oauth2.SpotifyOauthError, requests.exceptions.RequestException) as e:
+        print(f"Login failed: {e}")
+        login_error = str(e)
+        login_complete.set()
+        return render_template_string("""
+        <html>
+            <body>
+                <h1>Login Failed</h1>
+                <p>{{ error }}</p>
+            </body>
+        </html>
+    """, error=login_error), 400
     print("Access token fetched successfully.")
+    login_complete.set()
+    threading.Thread(target=refresh_devices, name="device-refresh-login", daemon=True).start()  # Don't wait a full interval for the device list
     return render_template_string("""
         <html>
             <body>
@@ -61,22 +297,33 @@ def callback():
         </html>
     """)
 
+@app.route('/wait_login', methods=['GET'])
+def wait_login():
+    """Block until /callback completes the login started with /login, or the timeout passes."""
+    timeout = min(request.args.get('timeout', resilience.deadline("login"), type=float), resilience.deadline("login"))
+    if not login_complete.wait(timeout):
+        return jsonify({"logged_in": False, "error": "Timed out waiting for login"}), 408
+    if login_error:
+        return jsonify({"logged_in": False, "error": login_error}), 401
+    token = cached_access_token()
+    if not token:
+        return jsonify({"logged_in": False, "error": "No cached token found"}), 401
+    return jsonify({"logged_in": True, "access_token": token})
+
 @app.route('/logout', methods=['POST'])
 def logout():
     """Log out by clearing the cached token."""
-    cache_handler = sp_oauth.cache_handler
-    if isinstance(cache_handler, spotipy.cache_handler.CacheFileHandler):
-        cache_path = cache_handler.cache_path
-        if os.path.exists(cache_path):
-            os.remove(cache_path)
-            print("Logged out and cache cleared.")
-            return jsonify({"message": "Logged out successfully."})
+    global last_playback
+    last_playback = None  # Don't show this account's playback after the next login
+    if token_cache.clear():
+        print("Logged out and cache cleared.")
+        return jsonify({"message": "Logged out successfully."})
     return jsonify({"message": "No cached token found."})
 
 @app.route('/token', methods=['GET'])
 def get_token():
     """Fetch the cached access token."""
-    token_info = sp_oauth.get_cached_token()
+    token_info = cached_token_info()
     if token_info:
         return jsonify({"access_token": token_info['access_token']})
     return jsonify({"error": "No cached token found."}), 404
@@ -85,48 +332,96 @@ def get_token():
 def token_status():
     """Check if a token is cached and refresh it if expired."""
     try:
-        token_info = sp_oauth.get_cached_token()
+        token_info = cached_token_info()  # Refreshes the token if it has expired
         if not token_info:
             print("No cached token found.")
             return jsonify({"logged_in": False, "error": "No cached token found"}), 401
 
-        # Refresh the token if it has expired
-        if sp_oauth.is_token_expired(token_info):
-            print("Access token expired. Refreshing...")
-            token_info = sp_oauth.refresh_access_token(token_info['refresh_token'])
-            print(f"Access token refreshed successfully: {token_info['access_token']}")
-
         return jsonify({"logged_in": True, "access_token": token_info['access_token']})
     except Exception as e:
         print(f"Error refreshing token: {e}")
         return jsonify({"logged_in": False, "error": "Failed to refresh token"}), 401
 
 @app.route('/current_track', methods=['GET'])
+@profiling.timed("/current_track")
 def current_track():
     """Fetch the currently playing track."""
-    token_info = sp_oauth.get_cached_token()
+    try:
+        token_info = cached_token_info()  # Refreshes the token if it has expired
+    except spotipy.exceptions.SpotifyOauthError as e:
+        print(f"Error refreshing access token: {e}")
+        return jsonify({"error": "Failed to refresh access token"}), 401
     if not token_info:
         return jsonify({"error": "Access token is missing or expired"}), 401
 
-    # Refresh the token if it has expired
-    if sp_oauth.is_token_expired(token_info):
-        try:
-            token_info = sp_oauth.refresh_access_token(token_info['refresh_token'])
-            print("Access token refreshed successfully.")
-        except spotipy.exceptions.SpotifyOauthError as e:
-            print(f"Error refreshing access token: {e}")
-            return jsonify({"error": "Failed to refresh access token"}), 401
-
+    global last_playback
     token = token_info['access_token']
     try:
-        sp = spotipy.Spotify(auth=token)
-        current_playback = sp.current_playback()
-        if current_playback:
-            return jsonify(current_playback)
-        else:
-            return jsonify({"error": "No track is currently playing"}), 404
+        current_playback = playback_breaker.call(read_playback, token)
+    except Exception as e:
+        if not is_upstream_failure(e):
+            if isinstance(e, spotipy.exceptions.SpotifyException):
+                return jsonify({"error": str(e)}), 401
+            raise
+        # Spotify is slow or down: answer with the last known state instead of making the client wait
+        print(f"Spotify is unavailable ({e}). Serving the last known playback state.")
+        if last_playback is None:
+            return jsonify({"error": "Spotify is not responding"}), 503
+        return jsonify(dict(last_playback, stale=True))
+
+    if current_playback:
+        last_playback = current_playback
+        return jsonify(current_playback)
+    else:
+        last_playback = None  # Never serve a finished track as stale during a later outage
+        return jsonify({"error": "No track is currently playing"}), 404
+
+@app.route('/devices', methods=['GET'])
+def devices():
+    """Return the cached list of the user's Spotify devices."""
+    device_cache_loaded.wait(timeout=resilience.deadline("devices"))  # Only waits before the first refresh
+    with device_cache_lock:
+        return jsonify({"devices": device_cache})
+
+@app.route('/devices/transfer', methods=['POST'])
+def transfer_device():
+    """Transfer playback to another device and return the updated device list."""
+    global device_cache
+    device_id = (request.get_json(silent=True) or {}).get("device_id")
+    if not device_id:
+        return jsonify({"error": "device_id is required"}), 400
+    token = cached_access_token()
+    if not token:
+        return jsonify({"error": "Access token is missing or expired"}), 401
+    try:
+        spotify_client(token, "transfer").transfer_playback(device_id, force_play=False)
     except spotipy.exceptions.SpotifyException as e:
-        return jsonify({"error": str(e)}), 401
+        return jsonify({"error": str(e)}), e.http_status
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": str(e)}), 503
+
+    # Spotify accepted the switch, so update the cache now rather than waiting for the next refresh
+    with device_cache_lock:
+        device_cache = [dict(device, is_active=device["id"] == device_id) for device in device_cache]
+        return jsonify({"devices": device_cache})
+
+@app.route('/queue', methods=['POST'])
+@profiling.timed("/queue")
+def queue_items():
+    """Add tracks, albums and playlists to the playback queue and report each item's outcome."""
+    body = request.get_json(silent=True) or {}
+    items = [item for item in body.get("items", []) if isinstance(item, str) and item.strip()]
+    if not items:
+        return jsonify({"error": "items must be a non-empty list of Spotify URIs or links"}), 400
+    token = cached_access_token()
+    if not token:
+        return jsonify({"error": "Access token is missing or expired"}), 401
+
+    results = enqueue_items(token, items, ordered=bool(body.get("ordered", True)))
+    failed = sum(not result["ok"] for result in results)
+    print(f"Queued {len(results) - failed} of {len(results)} items.")
+    return jsonify({"queued": len(results) - failed, "failed": failed, "results": results})
 
 if __name__ == '__main__':
+    start_device_refresher()
     app.run(port=5000)
\ No newline at end of file
@@ -0,0 +1,439 @@
+"""
+UI-independent core of the Spotify Controller.
+
+Holds the access token, the now-playing view-model, the track poller, the playback
+requests and the backend process supervisor. SpotifyController.py wires it to the Tk
+window; soak.py drives it headless against a fake Spotify API.
+"""
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import profiling
+import resilience
+
+BACKEND_URL = "http://localhost:5000"
+SPOTIFY_API_URL = "https://api.spotify.com/v1"
+POLL_INTERVAL = 3  # Seconds between current track polls
+DEVICE_POLL_EVERY = 5  # Re-read the backend's cached device list every this many polls
+NO_TRACK_TEXT = "No track is currently playing."
+TRACK_ERROR_TEXT = "Error fetching current track."
+MAX_BACKEND_RESTARTS = 5  # Give up restarting a backend that keeps exiting
+
+# Errors that mean Spotify or the backend could not be reached in time
+UPSTREAM_ERRORS = (requests.exceptions.RequestException, resilience.CircuitOpenError, resilience.DeadlineExceeded)
+
+
+class NowPlayingState:
+    """
+    Thread-safe view-model for the now-playing display.
+    Worker threads write fields with update(); only fields whose value actually
+    changed are queued for the UI pump, which applies them on the Tk thread.
+    """
+    def __init__(self, **fields):
+        self._lock = threading.Lock()
+        self._fields = dict(fields)
+        self._dirty = []  # Changed field names, oldest first
+
+    def get(self, name, default=None):
+        """Return the current value of a field."""
+        with self._lock:
+            return self._fields.get(name, default)
+
+    def update(self, **fields):
+        """Store new field values and mark the ones that differ as changed."""
+        with self._lock:
+            for name, value in fields.items():
+                if name in self._fields and self._fields[name] == value:
+                    continue
+                self._fields[name] = value
+                if name not in self._dirty:
+                    self._dirty.append(name)
+
+    def touch(self, name):
+        """Mark a field as changed without changing it, so the UI renders its current value again."""
+        with self._lock:
+            if name not in self._dirty:
+                self._dirty.append(name)
+
+    def pop_change(self):
+        """Return the oldest pending (name, value) change, or None if nothing changed."""
+        with self._lock:
+            if not self._dirty:
+                return None
+            name = self._dirty.pop(0)
+            return name, self._fields[name]
+
+
+class BackendSupervisor:
+    """
+    Runs the backend as a child process and restarts it if it exits, so polling doesn't
+    silently stop. popen_kwargs are passed to subprocess.Popen on every start.
+    """
+    def __init__(self, command, max_restarts=MAX_BACKEND_RESTARTS, **popen_kwargs):
+        self.command = command
+        self.max_restarts = max_restarts
+        self.popen_kwargs = popen_kwargs
+        self.process = None
+        self.restarts = 0
+        self.gave_up = False  # Set once the restarts are used up
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the backend process."""
+        self.process = subprocess.Popen(self.command, **self.popen_kwargs)
+
+    def ensure_running(self):
+        """Restart the backend if it has exited. Returns True if it is running."""
+        with self._lock:
+            if self.process.poll() is None:
+                return True
+            if self.restarts >= self.max_restarts:
+                if not self.gave_up:
+                    self.gave_up = True
+                    print(f"Backend server keeps exiting; gave up after {self.max_restarts} restarts.")
+                return False
+            self.restarts += 1
+            print(f"Backend server is not running. Restarting it ({self.restarts}/{self.max_restarts})...")
+            self.start()
+            return True
+
+    def stop(self):
+        """Terminate the backend and wait for it to exit."""
+        with self._lock:
+            if self.process is not None and self.process.poll() is None:
+                self.process.terminate()
+                self.process.wait()
+
+
+class SystemClock:
+    """Wall-clock time source for the poller. soak.py substitutes an accelerated clock."""
+    def time(self):
+        return time.time()
+
+    def wait(self, event, seconds):
+        """Block until the event is set or the given number of seconds has passed."""
+        return event.wait(seconds)
+
+
+class ControllerCore:
+    """Client state and requests shared by every front end of the controller."""
+    def __init__(self, backend_url=BACKEND_URL, api_url=SPOTIFY_API_URL, clock=None, poll_interval=POLL_INTERVAL, hedge_reads=True):
+        self.backend_url = backend_url
+        self.api_url = api_url
+        self.clock = clock or SystemClock()
+        self.poll_interval = poll_interval
+        self.access_token = None
+        self.hedge_reads = hedge_reads  # Back up slow Web API reads with a second request after the recent p95
+        # devices is a tuple of (id, name) pairs so the view-model can diff it cheaply
+        self.now_playing = NowPlayingState(track_text=NO_TRACK_TEXT, volume=None, stale=False, devices=(), active_device=None)
+        self.should_poll = None  # Optional callable; a poll tick is skipped while it returns False
+        self.on_token_expired = None  # Optional callable, run on the poller thread when the backend reports 401
+        self._session = requests.Session()  # Reuses connections instead of opening one per request
+        self.spotify_breaker = resilience.CircuitBreaker(
+            "Spotify Web API", is_failure=lambda error: isinstance(error, (requests.exceptions.RequestException, resilience.DeadlineExceeded))
+        )
+        self._read_latency = resilience.LatencyTracker()
+        self._hedge_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hedge")
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._poller = None
+        self._requested_volume = None  # Latest volume asked for with request_volume() and not yet sent
+        self._volume_lock = threading.Lock()
+        self._volume_wake = threading.Event()
+        self._volume_worker = None
+
+    def _spotify_request(self, method, path, endpoint, **kwargs):
+        """
+        Call the Spotify Web API with the current access token, within the endpoint's deadline
+        and through the circuit breaker. The backend refreshes the token on its own, so a 401
+        here means our copy is stale: fetch the current one and retry once.
+        """
+        def send():
+            headers = {"Authorization": f"Bearer {self.access_token}"}
+            response = self._session.request(method, f"{self.api_url}{path}", headers=headers, timeout=resilience.deadline(endpoint), **kwargs)
+            if response.status_code >= 500:
+                response.raise_for_status()  # Counts against the circuit breaker
+            return response
+
+        def call():
+            if method == "GET" and self.hedge_reads:
+                return resilience.hedged_call(send, self._read_latency, self._hedge_pool, resilience.deadline(endpoint))
+            return send()
+
+        response = self.spotify_breaker.call(call)
+        if response.status_code == 401 and self.check_token_status() == 200:
+            response = self.spotify_breaker.call(call)
+        return response
+
+    def _mark_stale(self):
+        """Keep showing the last known track, flagged as stale, when fresh data can't be fetched."""
+        if self.now_playing.get("track_text") in (NO_TRACK_TEXT, TRACK_ERROR_TEXT):
+            self.now_playing.update(track_text=TRACK_ERROR_TEXT)
+        else:
+            self.now_playing.update(stale=True)
+
+    @profiling.timed("check_token_status")
+    def check_token_status(self):
+        """
+        Ask the backend for a valid access token, refreshing it there if it expired.
+        Returns the backend's status code, or None if the backend could not be reached.
+        """
+        try:
+            response = self._session.get(f"{self.backend_url}/token_status", timeout=resilience.deadline("backend"))
+            if response.status_code == 200:
+                self.access_token = response.json().get("access_token")
+                print("Access token is valid.")
+            elif response.status_code == 401:
+                print("Access token expired or invalid. Please log in again.")
+            else:
+                print(f"Unexpected error: {response.json().get('error', 'Unknown error')}")
+            return response.status_code
+        except Exception as e:
+            print(f"Error checking token status: {e}")
+            return None
+
+    def wait_for_login(self):
+        """
+        Block until the backend's /callback finishes the login started with /login, then
+        take the new access token. Returns True on success, False if the login failed or timed out.
+        """
+        try:
+            response = self._session.get(
+                f"{self.backend_url}/wait_login",
+                params={"timeout": resilience.deadline("login")},
+                timeout=resilience.deadline("login") + resilience.deadline("backend"),
+            )
+            if response.status_code == 200:
+                self.access_token = response.json().get("access_token")
+                print("Access token fetched successfully.")
+                return True
+            print(f"Login did not complete: {response.json().get('error', 'Unknown error')}")
+        except Exception as e:
+            print(f"Error waiting for login: {e}")
+        return False
+
+    def logout(self):
+        """Forget the access token here and in the backend's cache, so the next launch asks to log in."""
+        self.access_token = None
+        try:
+            self._session.post(f"{self.backend_url}/logout", timeout=resilience.deadline("backend"))
+        except Exception as e:
+            print(f"Error clearing the cached token: {e}")
+
+    @profiling.timed("fetch_current_track")
+    def fetch_current_track(self):
+        """Fetch the currently playing track and publish it to the now-playing view-model."""
+        if not self.access_token:
+            print("You must log in first!")
+            return
+        try:
+            print("Fetching current track...")
+            response = self._session.get(
+                f"{self.backend_url}/current_track", params={"token": self.access_token}, timeout=resilience.deadline("backend")
+            )
+            if response.status_code == 401:  # Token expired
+                print("Access token expired. Refreshing token...")
+                # The next poll retries the fetch with whatever token the handler obtained
+                if self.on_token_expired:
+                    self.on_token_expired()
+                return
+            if response.status_code != 200:
+                print(f"Error fetching current track: {response.json().get('error', 'Unknown error')}")
+                self.now_playing.update(track_text=TRACK_ERROR_TEXT, stale=False)
+                return
+            current_track = response.json()
+            if current_track and current_track.get("item"):
+                track_name = current_track["item"]["name"]
+                artist_name = current_track["item"]["artists"][0]["name"]
+                # The backend flags the state as stale when it is serving its last copy while Spotify is unhealthy
+                self.now_playing.update(track_text=f"Now Playing: {artist_name} - {track_name}", stale=bool(current_track.get("stale")))
+                # The playback state already carries the device volume, so keep the slider in sync for free
+                device = current_track.get("device") or {}
+                if device.get("volume_percent") is not None:
+                    self.now_playing.update(volume=device["volume_percent"])
+                if device.get("id"):
+                    self.now_playing.update(active_device=device["id"])
+            else:
+                self.now_playing.update(track_text=NO_TRACK_TEXT, stale=False)
+        except UPSTREAM_ERRORS as e:
+            print(f"Request failed: {e}")
+            self._mark_stale()
+
+    def fetch_current_volume(self):
+        """Fetch the current Spotify playback volume and publish it to the view-model."""
+        if not self.access_token:
+            print("You must log in first!")
+            return
+        try:
+            response = self._spotify_request("GET", "/me/player", "player")
+            if response.status_code == 200:
+                current_volume = response.json().get("device", {}).get("volume_percent", 0)
+                self.now_playing.update(volume=current_volume)
+                print(f"Current Spotify volume: {current_volume}%.")
+            else:
+                print(f"Error fetching current volume: {response.json().get('error', 'Unknown error')}")
+        except UPSTREAM_ERRORS as e:
+            print(f"Request failed: {e}")
+
+    def set_volume(self, volume):
+        """Set the Spotify playback volume. Returns True if Spotify accepted it."""
+        if not self.access_token:
+            print("You must log in first!")
+            return False
+        try:
+            response = self._spotify_request("PUT", "/me/player/volume", "volume", params={"volume_percent": volume})
+            if response.status_code == 204:
+                self.now_playing.update(volume=volume)
+                return True
+            print(f"Error setting volume: {response.json().get('error', 'Unknown error')}")
+        except UPSTREAM_ERRORS as e:
+            print(f"Request failed: {e}")
+        return False
+
+    def request_volume(self, volume):
+        """
+        Set the Spotify playback volume on a worker thread, e.g. while a slider is dragged.
+        Volumes requested while a change is in flight are combined: only the latest is sent.
+        """
+        with self._volume_lock:
+            self._requested_volume = volume
+            if self._volume_worker is None:
+                self._volume_worker = threading.Thread(target=self._volume_loop, name="volume-setter", daemon=True)
+                self._volume_worker.start()
+        self._volume_wake.set()
+
+    def _volume_loop(self):
+        while True:
+            self._volume_wake.wait()
+            self._volume_wake.clear()
+            with self._volume_lock:
+                volume, self._requested_volume = self._requested_volume, None
+            if volume is None:
+                continue
+            if self.set_volume(volume):
+                print(f"Spotify volume set to {volume}%.")
+            else:
+                self.now_playing.touch("volume")  # Move the slider back to the volume Spotify still has
+
+    def change_volume(self, delta):
+        """Move the Spotify playback volume by delta percent, clamped to 0-100."""
+        if not self.access_token:
+            print("You must log in first!")
+            return
+        try:
+            # Get the current volume
+            response = self._spotify_request("GET", "/me/player", "player")
+            if response.status_code != 200:
+                print(f"Error fetching current playback: {response.json().get('error', 'Unknown error')}")
+                return
+        except UPSTREAM_ERRORS as e:
+            print(f"Request failed: {e}")
+            return
+        current_volume = response.json().get("device", {}).get("volume_percent", 0)
+        new_volume = max(0, min(current_volume + delta, 100))
+        if self.set_volume(new_volume):
+            print(f"Spotify volume {'increased' if delta > 0 else 'decreased'} to {new_volume}%.")
+
+    def _publish_devices(self, devices):
+        self.now_playing.update(devices=tuple((device["id"], device["name"]) for device in devices if device.get("id")))
+        active = next((device["id"] for device in devices if device.get("is_active")), None)
+        if active:
+            self.now_playing.update(active_device=active)
+
+    def fetch_devices(self):
+        """Read the device list the backend keeps cached and publish it to the view-model."""
+        try:
+            response = self._session.get(f"{self.backend_url}/devices", timeout=resilience.deadline("backend"))
+            if response.status_code == 200:
+                self._publish_devices(response.json().get("devices", []))
+            else:
+                print(f"Error fetching devices: {response.json().get('error', 'Unknown error')}")
+        except UPSTREAM_ERRORS as e:
+            print(f"Request failed: {e}")
+
+    def transfer_playback(self, device_id):
+        """Move playback to another device. Returns True if Spotify accepted the switch."""
+        if not self.access_token:
+            print("You must log in first!")
+            return False
+        try:
+            response = self._session.post(
+                f"{self.backend_url}/devices/transfer", json={"device_id": device_id}, timeout=resilience.deadline("transfer")
+            )
+            if response.status_code == 200:
+                self._publish_devices(response.json().get("devices", []))
+                self.now_playing.update(active_device=device_id)
+                print(f"Playback transferred to device {device_id}.")
+                return True
+            print(f"Error transferring playback: {response.json().get('error', 'Unknown error')}")
+        except UPSTREAM_ERRORS as e:
+            print(f"Request failed: {e}")
+        return False
+
+    def cycle_device(self):
+        """Transfer playback to the next device in the cached list."""
+        devices = [device_id for device_id, _ in self.now_playing.get("devices")]
+        if not devices:
+            print("No Spotify devices available.")
+            return False
+        active = self.now_playing.get("active_device")
+        next_index = (devices.index(active) + 1) % len(devices) if active in devices else 0
+        if devices[next_index] == active:
+            print("Only one Spotify device is available.")
+            return False
+        return self.transfer_playback(devices[next_index])
+
+    def enqueue(self, items, ordered=True):
+        """
+        Add tracks, albums or playlists (URIs or links) to the queue through the backend, in order
+        unless ordered is False, which is faster but lets neighbouring tracks swap places.
+        Returns the backend's report with one result per queued track, or None if the request failed.
+        """
+        try:
+            response = self._session.post(
+                f"{self.backend_url}/queue", json={"items": list(items), "ordered": ordered}, timeout=resilience.deadline("bulk_queue")
+            )
+            report = response.json()
+            if response.status_code == 200:
+                print(f"Queued {report['queued']} items, {report['failed']} failed.")
+                return report
+            print(f"Error queueing items: {report.get('error', 'Unknown error')}")
+        except UPSTREAM_ERRORS as e:
+            print(f"Request failed: {e}")
+        return None
+
+    def start_polling(self):
+        """Start the single long-lived poller thread if it isn't running yet."""
+        if self._poller is not None and self._poller.is_alive():
+            return
+        self._stop.clear()
+        self._poller = threading.Thread(target=self._poll_loop, name="track-poller", daemon=True)
+        self._poller.start()
+
+    def stop_polling(self):
+        """Stop the poller thread and wait for it to exit."""
+        self._stop.set()
+        self._wake.set()
+        if self._poller is not None:
+            self._poller.join()
+            self._poller = None
+
+    def request_refresh(self):
+        """Wake the poller to fetch the track now. Bursts of calls collapse into one fetch."""
+        self._wake.set()
+
+    def _poll_loop(self):
+        tick = 0
+        while not self._stop.is_set():
+            try:
+                if self.should_poll is None or self.should_poll():
+                    self.fetch_current_track()
+                    if self.access_token and tick % DEVICE_POLL_EVERY == 0:
+                        self.fetch_devices()
+                    tick += 1
+            except Exception as e:
+                print(f"Error during periodic fetch: {e}")
+            self.clock.wait(self._wake, self.poll_interval)
+            self._wake.clear()
@@ -0,0 +1,35 @@
+"""
+Queue tracks, albums and playlists from the command line.
+
+Usage: python enqueue.py [--unordered] URI_OR_LINK [URI_OR_LINK ...]
+With no arguments the items are read from standard input, one or more per line.
+The backend must be running (it is started by SpotifyController.py, or run backend.py).
+Exits with status 1 if any item could not be queued.
+"""
+import argparse
+import sys
+from controller_core import BACKEND_URL, ControllerCore
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add Spotify tracks, albums and playlists to the playback queue.")
+    parser.add_argument("items", nargs="*", help="spotify: URIs or open.spotify.com links")
+    parser.add_argument("--unordered", action="store_true", help="queue several tracks at once; faster, but neighbouring tracks can swap places")
+    parser.add_argument("--backend", default=BACKEND_URL, help=f"backend URL (default {BACKEND_URL})")
+    args = parser.parse_args()
+
+    items = args.items or sys.stdin.read().split()
+    if not items:
+        parser.error("no items to queue")
+
+    report = ControllerCore(backend_url=args.backend).enqueue(items, ordered=not args.unordered)
+    if report is None:
+        sys.exit(1)
+    for result in report["results"]:
+        print(f"{'ok    ' if result['ok'] else 'FAILED'} {result['uri']}" + (f"  ({result['error']})" if result["error"] else ""))
+    if report["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
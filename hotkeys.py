@@ -0,0 +1,156 @@
+"""
+Global hotkey engine for the controller.
+
+The keyboard hook only timestamps each press and release and puts it on a queue, so it
+never waits on the network. A dispatcher thread takes events off the queue, records the
+press-to-dispatch latency and runs the bound action. Holding a key down (the OS repeats
+the press until the key is released) is detected: held volume keys step at a fixed rate
+with a step that grows the longer the key is held, and the steps queued while a change
+is in flight are combined into one change; other held keys fire once.
+"""
+import queue
+import threading
+import time
+from collections import deque
+
+try:
+    import keyboard
+except ImportError:
+    keyboard = None  # Only bind() needs it; soak.py drives the engine through handle_event()
+
+import profiling
+
+VOLUME_STEP = 5  # Percent per volume key press, before held-key acceleration
+VOLUME_ACTIONS = {"volume_up": VOLUME_STEP, "volume_down": -VOLUME_STEP}  # Signed base steps for the volume actions
+REPEAT_GAP = 1.0  # Seconds; a press further apart than this from the last one is never a repeat
+VOLUME_STEPS_PER_SECOND = 5  # Volume steps applied while a volume key is held, however fast the OS repeats it
+ACCELERATE_EVERY = 1.0  # Seconds a volume key must stay held for its step to grow by one base step
+MAX_ACCELERATION = 3  # Largest multiple of the base volume step
+MAX_PENDING_VOLUME = 100  # Percent; queued volume changes never add up to more than this either way
+LATENCY_SAMPLES = 500  # Recent press-to-dispatch latencies kept for the summary
+
+
+class HotkeyEngine:
+    """
+    Binds shortcuts to actions and dispatches them off the keyboard hook thread.
+    actions maps action names to zero-argument callables; they run on the dispatcher
+    thread, so they must return quickly. volume_steps maps action names to a signed base
+    step in percent; those actions are handled by change_volume(delta) on a separate thread.
+    """
+    def __init__(self, actions, volume_steps, change_volume):
+        self.actions = actions
+        self.volume_steps = volume_steps
+        self.change_volume = change_volume
+        self._events = queue.SimpleQueue()
+        self._bindings = {}  # Maps action names to (hotkey handle, key release hook handles)
+        self._held = {}  # Maps action names to (hold start, last press, last volume step) while the key is down
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._latency_lock = threading.Lock()
+        self._pending_volume = 0
+        self._volume_lock = threading.Lock()
+        self._volume_wake = threading.Event()
+        threading.Thread(target=self._dispatch_loop, name="hotkey-dispatcher", daemon=True).start()
+        threading.Thread(target=self._volume_loop, name="hotkey-volume", daemon=True).start()
+
+    def bind(self, action, shortcut):
+        """Bind shortcut to action, replacing the action's previous shortcut."""
+        if keyboard is None:
+            raise RuntimeError("The keyboard package is required to bind global shortcuts.")
+        self.unbind(action)
+        hotkey = keyboard.add_hotkey(shortcut, self.handle_event, args=("press", action))
+        # Releasing any key of the combination ends a hold; the hotkey's own release
+        # callback misses the case where a modifier is let go first
+        scan_codes = {code for step in keyboard.parse_hotkey(shortcut) for key in step for code in key}
+        releases = [
+            keyboard.on_release_key(code, lambda event, action=action: self.handle_event("release", action))
+            for code in scan_codes
+        ]
+        self._bindings[action] = (hotkey, releases)
+
+    def unbind(self, action):
+        """Remove the action's shortcut, if it has one."""
+        if action not in self._bindings:
+            return
+        hotkey, releases = self._bindings.pop(action)
+        keyboard.remove_hotkey(hotkey)
+        for release in releases:
+            keyboard.unhook(release)
+
+    def press(self, action):
+        """Dispatch action as a single press from a button. Button presses are left out of the latency stats."""
+        self.handle_event("press", action, timed=False)
+        self.handle_event("release", action, timed=False)
+
+    def handle_event(self, kind, action, timed=True):
+        """
+        Queue a "press" or "release" of action. Called on the keyboard hook thread, so it only
+        timestamps and hands off. Presses with timed set count towards the latency stats.
+        """
+        self._events.put((kind, action, time.perf_counter(), timed))
+
+    def latency_summary(self):
+        """Return press-to-dispatch latency statistics in milliseconds, or None before the first press."""
+        with self._latency_lock:
+            samples = sorted(self._latencies)
+        if not samples:
+            return None
+        return {
+            "presses": len(samples),
+            "mean": sum(samples) / len(samples) * 1000,
+            "p95": samples[max(int(len(samples) * 0.95) - 1, 0)] * 1000,
+            "max": samples[-1] * 1000,
+        }
+
+    def _dispatch_loop(self):
+        while True:
+            kind, action, pressed_at, timed = self._events.get()
+            if kind == "release":
+                self._held.pop(action, None)
+                continue
+
+            if timed:
+                latency = time.perf_counter() - pressed_at
+                with self._latency_lock:
+                    self._latencies.append(latency)
+                profiling.record("hotkey_dispatch", latency)
+
+            # A press with no release since the last one is the OS repeating a held key
+            held = self._held.get(action)
+            if held is None or pressed_at - held[1] >= REPEAT_GAP:
+                self._held[action] = (pressed_at, pressed_at, pressed_at)
+                if action in self.volume_steps:
+                    self._add_volume(self.volume_steps[action])
+                else:
+                    self._run(action)
+                continue
+
+            hold_start, last_press, last_step = held
+            if action in self.volume_steps and pressed_at - last_step >= 1 / VOLUME_STEPS_PER_SECOND:
+                acceleration = min(1 + int((pressed_at - hold_start) / ACCELERATE_EVERY), MAX_ACCELERATION)
+                self._add_volume(self.volume_steps[action] * acceleration)
+                last_step = pressed_at
+            self._held[action] = (hold_start, pressed_at, last_step)
+
+    def _run(self, action):
+        try:
+            self.actions[action]()
+        except Exception as e:
+            print(f"Error running {action}: {e}")
+
+    def _add_volume(self, delta):
+        with self._volume_lock:
+            self._pending_volume = max(-MAX_PENDING_VOLUME, min(self._pending_volume + delta, MAX_PENDING_VOLUME))
+        self._volume_wake.set()
+
+    def _volume_loop(self):
+        """Apply queued volume steps, combining everything pressed while a change was in flight."""
+        while True:
+            self._volume_wake.wait()
+            self._volume_wake.clear()
+            with self._volume_lock:
+                delta, self._pending_volume = self._pending_volume, 0
+            if delta:
+                try:
+                    self.change_volume(delta)
+                except Exception as e:
+                    print(f"Error changing volume: {e}")
@@ -0,0 +1,185 @@
+"""
+Runtime profiling shared by the controller and the backend.
+
+Start either program with --profile to turn it on. While enabled, the main thread is
+profiled with cProfile, every thread's stack is sampled, live threads are counted and
+tracemalloc snapshots are diffed periodically. Functions wrapped with @timed record their
+call timings, and record() adds timings measured elsewhere. The report is written to a
+text file on exit, or on demand by sending SIGUSR1 (SIGBREAK / Ctrl+Break on Windows).
+"""
+import atexit
+import cProfile
+import functools
+import io
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+
+PROFILE_FLAG = "--profile"
+SAMPLE_INTERVAL = 0.01  # Seconds between stack samples
+SNAPSHOT_INTERVAL = 60  # Seconds between tracemalloc snapshots
+MEMORY_DIFFS_KEPT = 5  # Number of recent tracemalloc diffs kept for the report
+REPORT_TOP = 25  # Rows shown per report section
+
+enabled = False
+_report_path = None
+_started_at = None
+_profiler = None
+_lock = threading.RLock()  # Reentrant so a signal-triggered dump can't deadlock the main thread
+_timers = {}  # Maps timer names to [calls, total seconds, max seconds]
+_self_samples = Counter()  # Code object at the top of a sampled stack
+_total_samples = Counter()  # Code object anywhere in a sampled stack
+_sample_count = 0
+_peak_threads = 0
+_memory_diffs = deque(maxlen=MEMORY_DIFFS_KEPT)
+_own_threads = set()  # Idents of the profiler's threads, left out of the stack samples
+
+
+def profile_requested(argv=None):
+    """Return True if the command line asks for profiling."""
+    return PROFILE_FLAG in (sys.argv if argv is None else argv)
+
+
+def enable(report_path):
+    """Start profiling and arrange for the report to be written to report_path."""
+    global enabled, _report_path, _started_at, _profiler
+    if enabled:
+        return
+    enabled = True
+    _report_path = report_path
+    _started_at = time.time()
+
+    tracemalloc.start()
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+    threading.Thread(target=_sample_stacks, name="profiling-sampler", daemon=True).start()
+    threading.Thread(target=_watch_memory, name="profiling-memory", daemon=True).start()
+
+    atexit.register(dump_report)
+    report_signal = getattr(signal, "SIGUSR1", None) or getattr(signal, "SIGBREAK", None)
+    if report_signal is not None:
+        signal.signal(report_signal, lambda signum, frame: dump_report())
+    print(f"Profiling enabled. Report will be written to {report_path}.")
+
+
+def timed(name):
+    """Decorator that records call count and durations under name while profiling is enabled."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def record(name, elapsed):
+    """Add one timing of elapsed seconds under name while profiling is enabled."""
+    if not enabled:
+        return
+    with _lock:
+        timer = _timers.setdefault(name, [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += elapsed
+        timer[2] = max(timer[2], elapsed)
+
+
+def _sample_stacks():
+    """Sample every thread's stack, since cProfile only sees the thread that enabled it."""
+    global _sample_count, _peak_threads
+    _own_threads.add(threading.get_ident())
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        frames = sys._current_frames()
+        # Walk the stacks outside the lock, so timed() and record() callers never wait on it;
+        # code objects are only turned into names when the report is written
+        self_samples = Counter()
+        total_samples = Counter()
+        for ident, frame in frames.items():
+            if ident in _own_threads:
+                continue
+            self_samples[frame.f_code] += 1
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                if code not in seen:
+                    seen.add(code)
+                    total_samples[code] += 1
+                frame = frame.f_back
+        with _lock:
+            _sample_count += 1
+            _peak_threads = max(_peak_threads, threading.active_count())
+            _self_samples.update(self_samples)
+            _total_samples.update(total_samples)
+
+
+def _describe(code):
+    return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+
+def _watch_memory():
+    """Diff tracemalloc snapshots periodically to show where memory keeps growing."""
+    _own_threads.add(threading.get_ident())
+    ignore_self = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    previous = tracemalloc.take_snapshot().filter_traces(ignore_self)
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        snapshot = tracemalloc.take_snapshot().filter_traces(ignore_self)
+        top = snapshot.compare_to(previous, "lineno")[:REPORT_TOP // 2]
+        previous = snapshot
+        lines = [f"  {stat}" for stat in top]
+        with _lock:
+            _memory_diffs.append((time.time() - _started_at, lines))
+
+
+def dump_report():
+    """Write the current profiling report to the report file."""
+    if not enabled:
+        return
+    out = io.StringIO()
+    with _lock:
+        uptime = time.time() - _started_at
+        out.write(f"Profile report after {uptime:.0f}s ({time.strftime('%Y-%m-%d %H:%M:%S')})\n\n")
+
+        threads = threading.enumerate()
+        out.write(f"Threads: {len(threads)} live, {_peak_threads} peak\n")
+        for name, count in Counter(thread.name for thread in threads).most_common():
+            out.write(f"  {count:4d}  {name}\n")
+
+        out.write("\nTimed hot paths (calls, total s, mean ms, max ms):\n")
+        for name, (calls, total, longest) in sorted(_timers.items(), key=lambda item: -item[1][1]):
+            out.write(f"  {name:30s} {calls:8d} {total:10.3f} {total / calls * 1000:10.2f} {longest * 1000:10.2f}\n")
+
+        out.write(f"\nSampled stacks ({_sample_count} samples, all threads), by self time:\n")
+        for code, count in _self_samples.most_common(REPORT_TOP):
+            out.write(f"  {count:8d}  {_describe(code)}\n")
+        out.write("\nSampled stacks, by total time:\n")
+        for code, count in _total_samples.most_common(REPORT_TOP):
+            out.write(f"  {count:8d}  {_describe(code)}\n")
+
+        current, peak = tracemalloc.get_traced_memory()
+        out.write(f"\nTraced memory: {current / 1024:.0f} KiB current, {peak / 1024:.0f} KiB peak\n")
+        for elapsed, lines in _memory_diffs:
+            out.write(f"Allocation growth over the {SNAPSHOT_INTERVAL}s before {elapsed:.0f}s:\n")
+            out.write("\n".join(lines) + "\n")
+
+    out.write("\ncProfile, main thread, by cumulative time:\n")
+    _profiler.disable()
+    pstats.Stats(_profiler, stream=out).sort_stats("cumulative").print_stats(REPORT_TOP)
+    _profiler.enable()
+
+    try:
+        with open(_report_path, "w", encoding="utf-8") as file:
+            file.write(out.getvalue())
+        print(f"Profile report written to {_report_path}.")
+    except OSError as e:
+        print(f"Error writing profile report: {e}")
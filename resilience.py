@@ -0,0 +1,179 @@
+"""
+Resilience helpers for calls to Spotify, shared by the controller and the backend.
+
+Provides per-endpoint deadlines, a circuit breaker that lets callers fall back to the
+last known state while Spotify is unhealthy, hedged requests for idempotent reads and
+a rate-limit gate shared by concurrent workers.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# Per-endpoint deadlines in seconds
+DEADLINES = {
+    "backend": 4,  # Controller to the local backend, which has its own upstream deadlines
+    "player": 3,  # GET /me/player
+    "volume": 3,  # PUT /me/player/volume
+    "devices": 3,  # GET /me/player/devices
+    "transfer": 5,  # PUT /me/player (transfer playback)
+    "queue": 5,  # POST /me/player/queue and album/playlist listing
+    "bulk_queue": 120,  # Controller to the backend's bulk /queue, which fans out many upstream calls
+    "token": 5,  # Token refreshes against accounts.spotify.com
+    "login": 300,  # Controller waiting on the backend's /wait_login while the user logs in
+}
+DEFAULT_DEADLINE = 5
+MIN_HEDGE_DELAY = 0.1  # Seconds; never hedge sooner than this
+DEFAULT_HEDGE_DELAY = 0.5  # Seconds; used until enough latencies have been seen for a p95
+
+
+def deadline(endpoint):
+    """Return the timeout in seconds for requests to the given endpoint."""
+    return DEADLINES.get(endpoint, DEFAULT_DEADLINE)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling upstream while a circuit breaker is open."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised by hedged_call when no attempt finished within its deadline."""
+
+
+class CircuitBreaker:
+    """
+    Stops calling an unhealthy upstream after repeated failures.
+    After failure_threshold consecutive failures the breaker opens and call() raises
+    CircuitOpenError straight away. Once reset_timeout seconds have passed a single
+    trial call is let through; success closes the breaker again, failure re-opens it.
+    is_failure decides which exceptions count against the upstream's health.
+    """
+    def __init__(self, name, failure_threshold=3, reset_timeout=30, is_failure=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure or (lambda error: True)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def call(self, func, *args, **kwargs):
+        """Call func through the breaker."""
+        with self._lock:
+            if self._opened_at is not None:
+                if self._trial_running or time.monotonic() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"{self.name} circuit is open")
+                self._trial_running = True
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._record(failed=self.is_failure(e))
+            raise
+        self._record(failed=False)
+        return result
+
+    def _record(self, failed):
+        with self._lock:
+            self._trial_running = False
+            if not failed:
+                if self._opened_at is not None:
+                    print(f"{self.name} circuit closed.")
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"{self.name} circuit opened after {self._failures} failures.")
+                self._opened_at = time.monotonic()
+
+
+class RateLimitGate:
+    """
+    Shares a rate-limit pause between concurrent workers: once one of them is told to
+    back off, every worker waits until the Retry-After period is over before sending.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0
+
+    def pause(self, seconds):
+        """Hold all workers for the given number of seconds."""
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    def wait(self):
+        """Block until no pause is in effect."""
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+
+class LatencyTracker:
+    """Keeps the most recent call latencies to estimate the 95th percentile."""
+    def __init__(self, size=200, min_samples=20):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=size)
+        self._min_samples = min_samples
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def p95(self):
+        """Return the 95th percentile latency in seconds, or None until enough samples exist."""
+        with self._lock:
+            if len(self._samples) < self._min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+def hedged_call(func, latency, executor, timeout):
+    """
+    Run func and, if it hasn't returned by the p95 of recent latencies, start an identical
+    backup call and return whichever succeeds first. Only use this for idempotent reads.
+    Raises DeadlineExceeded if neither has succeeded or failed after timeout seconds.
+    """
+    def attempt():
+        start = time.perf_counter()
+        result = func()
+        latency.record(time.perf_counter() - start)
+        return result
+
+    give_up_at = time.perf_counter() + timeout
+    pending = {executor.submit(attempt)}
+    delay = max(latency.p95() or DEFAULT_HEDGE_DELAY, MIN_HEDGE_DELAY)
+    done, pending = wait(pending, timeout=min(delay, timeout))
+    if not done and time.perf_counter() < give_up_at:
+        pending.add(executor.submit(attempt))
+
+    error = None
+    while done or pending:
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            for other in pending:
+                other.cancel()
+            return result
+        if not pending:
+            break
+        remaining = give_up_at - time.perf_counter()
+        if remaining <= 0:
+            for other in pending:
+                other.cancel()  # Attempts already running finish in the background, bounded by their own timeouts
+            raise DeadlineExceeded(f"No response within {timeout} seconds")
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+    raise error
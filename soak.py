@@ -0,0 +1,452 @@
+"""
+Endurance (soak) harness for the controller core and backend.py.
+
+Runs ControllerCore and a HotkeyEngine in this process and backend.py as a child process
+under a BackendSupervisor, all against a local fake Spotify API and an accelerated clock, so a day of polling, token
+expiries, hotkey bursts, bulk queueing and a backend outage plays out in a few minutes. Afterwards it
+checks that RSS, thread count, open sockets and upstream call counts stayed in bounds.
+
+Usage: python soak.py [--hours 24] [--minutes 3] [--verbose]
+Exits with status 1 if any bound was exceeded.
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from controller_core import BackendSupervisor, ControllerCore
+from hotkeys import HotkeyEngine, VOLUME_ACTIONS, VOLUME_STEPS_PER_SECOND
+
+TOKEN_LIFETIME = 3600  # Seconds, as issued by Spotify
+TRACK_LENGTH = 240  # Virtual seconds before the fake player moves to the next track
+SAMPLE_EVERY = 600  # Virtual seconds between resource samples
+BURST_EVERY = 1200  # Virtual seconds between hotkey bursts
+BURST_PRESSES = 8  # Skip and volume taps per hotkey burst
+HOLD_SECONDS = 0.5  # Wall-clock seconds a volume key is held down in every burst
+KEY_REPEAT_RATE = 30  # Presses per second the OS sends for a held key
+MAX_DISPATCH_P95_MS = 50  # Allowed p95 hotkey press-to-dispatch latency
+ALBUM_TRACKS = 30  # Tracks on the fake album bulk-queued with every hotkey burst
+RATE_LIMIT_EVERY = 25  # Every this many queue calls, the fake API answers 429
+RETRY_AFTER = 1  # Wall-clock seconds the fake API asks for after a 429
+WARMUP_FRACTION = 0.05  # Share of the run before resource baselines are taken
+BACKEND_DEVICE_REFRESH = 30  # backend.DEVICE_REFRESH_INTERVAL, which the backend process runs on virtual time
+
+# Allowed growth over the warmed-up baseline
+MAX_RSS_GROWTH = 64 * 1024 * 1024
+MAX_THREAD_GROWTH = 10
+MAX_SOCKET_GROWTH = 10
+CALL_SLACK = 1.05  # Allowed overshoot of the expected upstream call counts
+
+
+class AcceleratedClock:
+    """
+    Virtual time running speed times faster than the wall clock.
+    Anchored to a wall-clock start so the harness and the backend process agree on it.
+    """
+    def __init__(self, speed, real_start=None):
+        self.speed = speed
+        self.real_start = time.time() if real_start is None else real_start
+
+    def time(self):
+        return self.real_start + (time.time() - self.real_start) * self.speed
+
+    def elapsed(self):
+        """Virtual seconds since the clock started."""
+        return self.time() - self.real_start
+
+    def wait(self, event, seconds):
+        return event.wait(seconds / self.speed)
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.speed)
+
+
+class FakeSpotify(ThreadingHTTPServer):
+    """Minimal stand-in for api.spotify.com and accounts.spotify.com that counts every call."""
+    daemon_threads = True
+
+    def __init__(self, clock):
+        super().__init__(("127.0.0.1", 0), FakeSpotifyHandler)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.tokens = {}  # Maps issued access tokens to their virtual expiry time
+        self.volume = 50
+        self.devices = ["device-1", "device-2", "device-3"]
+        self.active_device = "device-1"
+        self.queue = []  # URIs added to the playback queue, in arrival order
+        self.rate_limited_at = None  # time.monotonic() of the last 429
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def issue_token(self):
+        with self.lock:
+            token = f"token-{len(self.tokens)}"
+            self.tokens[token] = self.clock.time() + TOKEN_LIFETIME
+        return {"access_token": token, "token_type": "Bearer", "expires_in": TOKEN_LIFETIME,
+                "refresh_token": "refresh-token", "scope": "user-read-playback-state user-modify-playback-state"}
+
+    def token_valid(self, header):
+        token = (header or "").replace("Bearer ", "")
+        with self.lock:
+            return self.tokens.get(token, 0) > self.clock.time()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_POST(self):
+        self._read_body()
+        url = urlsplit(self.path)
+        if url.path == "/api/token":
+            self.server.count("token_refresh")
+            self._send(200, self.server.issue_token())
+        elif url.path == "/v1/me/player/queue":
+            self.server.count("queue")
+            if self._authorized():
+                now = time.monotonic()
+                limited_at = self.server.rate_limited_at
+                if limited_at is not None and now < limited_at + RETRY_AFTER:
+                    self.server.count("queue_before_retry_after")
+                if self.server.calls["queue"] % RATE_LIMIT_EVERY == 0:
+                    self.server.rate_limited_at = now
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(RETRY_AFTER))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                with self.server.lock:
+                    self.server.queue.append(unquote(url.query.partition("uri=")[2]))
+                self._send(204)
+        else:
+            self._send(404, {"error": "Not found"})
+
+    def _authorized(self):
+        if self.server.token_valid(self.headers.get("Authorization")):
+            return True
+        self.server.count("unauthorized")
+        self._send(401, {"error": {"status": 401, "message": "The access token expired"}})
+        return False
+
+    def _device(self, device_id):
+        return {"id": device_id, "name": f"Soak {device_id}", "type": "Speaker",
+                "is_active": device_id == self.server.active_device, "volume_percent": self.server.volume}
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/v1/me/player":
+            self.server.count("player")
+            if self._authorized():
+                track = int(self.server.clock.elapsed() // TRACK_LENGTH)
+                self._send(200, {
+                    "is_playing": True,
+                    "device": self._device(self.server.active_device),
+                    "item": {"name": f"Track {track}", "artists": [{"name": "Soak Artist"}]},
+                })
+        elif path.rstrip("/") == "/v1/albums/soak/tracks":
+            self.server.count("album")
+            if self._authorized():
+                query = dict(pair.partition("=")[::2] for pair in urlsplit(self.path).query.split("&") if pair)
+                offset, limit = int(query.get("offset", 0)), int(query.get("limit", 20))
+                end = min(offset + limit, ALBUM_TRACKS)
+                self._send(200, {
+                    "items": [{"uri": f"spotify:track:soak{index}"} for index in range(offset, end)],
+                    "next": f"{self.server.url}{path}?offset={end}&limit={limit}" if end < ALBUM_TRACKS else None,
+                })
+        elif path == "/v1/me/player/devices":
+            self.server.count("devices")
+            if self._authorized():
+                self._send(200, {"devices": [self._device(device_id) for device_id in self.server.devices]})
+        else:
+            self._send(404, {"error": "Not found"})
+
+    def do_PUT(self):
+        body = self._read_body()
+        url = urlsplit(self.path)
+        if url.path == "/v1/me/player/volume":
+            self.server.count("volume")
+            if self._authorized():
+                for pair in url.query.split("&"):
+                    name, _, value = pair.partition("=")
+                    if name == "volume_percent":
+                        self.server.volume = int(value)
+                self._send(204)
+        elif url.path == "/v1/me/player":
+            self.server.count("transfer")
+            if self._authorized():
+                self.server.active_device = json.loads(body)["device_ids"][0]
+                self._send(204)
+        else:
+            self._send(404, {"error": "Not found"})
+
+
+def process_stats(pid):
+    """Return (rss bytes, threads, open sockets) for a process, or None if they can't be read here."""
+    if psutil is not None:
+        process = psutil.Process(pid)
+        return process.memory_info().rss, process.num_threads(), len(process.net_connections(kind="inet"))
+    proc = f"/proc/{pid}"
+    if not os.path.isdir(proc):
+        return None
+    with open(f"{proc}/status") as file:
+        status = dict(line.split(":", 1) for line in file if ":" in line)
+    sockets = 0
+    for fd in os.listdir(f"{proc}/fd"):
+        try:
+            sockets += os.readlink(f"{proc}/fd/{fd}").startswith("socket:")
+        except OSError:
+            pass
+    return int(status["VmRSS"].split()[0]) * 1024, int(status["Threads"]), sockets
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve_backend(port, speed, real_start):
+    """Child-process entry point: run backend.py's app with spotipy on the shared virtual clock."""
+    import spotipy.oauth2
+    spotipy.oauth2.time = AcceleratedClock(speed, real_start)  # Token expiry checks use virtual time
+    import backend
+    backend.DEVICE_REFRESH_INTERVAL /= speed
+    backend.start_device_refresher()
+    backend.app.run(port=port, threaded=True)
+
+
+def start_backend(workspace, port, speed, real_start, fake_url, verbose):
+    """Start the backend under the same supervisor the controller uses and wait until it accepts connections."""
+    env = dict(os.environ, SPOTIFY_API_URL=f"{fake_url}/v1/", SPOTIFY_ACCOUNTS_URL=fake_url)
+    command = [sys.executable, os.path.abspath(__file__), "--serve-backend", str(port), "--speed", str(speed),
+               "--real-start", str(real_start)]
+    output = None if verbose else subprocess.DEVNULL
+    supervisor = BackendSupervisor(command, cwd=workspace, env=env, stdout=output, stderr=output)
+    supervisor.start()
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.2):
+            return supervisor
+        time.sleep(0.05)
+    supervisor.stop()
+    raise RuntimeError("Backend did not start.")
+
+
+def tap_key(engine, action):
+    """Press and release a hotkey, as the keyboard hook reports it."""
+    engine.handle_event("press", action)
+    engine.handle_event("release", action)
+
+
+def hold_key(engine, action):
+    """Hold a hotkey down: the OS repeats the press until the key is released."""
+    for repeat in range(int(HOLD_SECONDS * KEY_REPEAT_RATE)):
+        engine.handle_event("press", action)
+        time.sleep(1 / KEY_REPEAT_RATE)
+    engine.handle_event("release", action)
+
+
+def prepare_workspace(fake, clock):
+    """Create a working directory holding credentials and a cached token for the backend."""
+    workspace = tempfile.mkdtemp(prefix="spotify-soak-")
+    with open(os.path.join(workspace, "credentials.json"), "w") as file:
+        json.dump({"CLIENT_ID": "soak", "CLIENT_SECRET": "soak", "REDIRECT_URI": "http://localhost:5000/callback"}, file)
+    token_info = fake.issue_token()
+    token_info["expires_at"] = int(clock.time()) + TOKEN_LIFETIME
+    with open(os.path.join(workspace, ".cache"), "w") as file:
+        json.dump(token_info, file)
+    return workspace
+
+
+def run_soak(hours, minutes, verbose):
+    duration = hours * 3600
+    speed = duration / (minutes * 60)
+    clock = AcceleratedClock(speed)
+    fake = FakeSpotify(clock)
+    threading.Thread(target=fake.serve_forever, name="fake-spotify", daemon=True).start()
+    workspace = prepare_workspace(fake, clock)
+    port = free_port()
+
+    backend = start_backend(workspace, port, speed, clock.real_start, fake.url, verbose)
+    core = ControllerCore(backend_url=f"http://127.0.0.1:{port}", api_url=f"{fake.url}/v1", clock=clock)
+    core.on_token_expired = core.check_token_status
+    core.should_poll = backend.ensure_running
+    # The UI's media-key actions need Windows; skips here just wake the poller, as they do there
+    engine = HotkeyEngine({
+        "skip": core.request_refresh,
+        "previous": core.request_refresh,
+        "cycle_device": lambda: threading.Thread(target=core.cycle_device, daemon=True).start(),
+    }, VOLUME_ACTIONS, core.change_volume)
+    outage = {"start": duration / 2, "done": False, "player_calls": 0}
+    print(f"Soaking {hours}h of virtual time in ~{minutes} min (x{speed:.0f}); backend on port {port}.")
+
+    peaks = {}
+    baselines = {}
+    bursts = 0
+    next_burst = BURST_EVERY
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with output:
+        core.check_token_status()
+        core.start_polling()
+        while clock.elapsed() < duration:
+            clock.sleep(SAMPLE_EVERY)
+
+            if clock.elapsed() >= next_burst:
+                # A burst of hotkey presses through the engine: skips, volume taps, a held volume key
+                for press in range(BURST_PRESSES):
+                    tap_key(engine, "skip")
+                    tap_key(engine, "volume_up" if press % 2 else "volume_down")
+                hold_key(engine, "volume_up")
+                tap_key(engine, "cycle_device")
+                core.enqueue(["spotify:album:soak"])  # Ordered, so no call is in flight during a 429
+                bursts += 1
+                next_burst += BURST_EVERY
+
+            if not outage["done"] and clock.elapsed() >= outage["start"]:
+                # Kill the backend; the supervisor should restart it on the next poll
+                backend.process.kill()
+                backend.process.wait()
+                outage["done"] = True
+                outage["player_calls"] = fake.calls["player"]
+
+            samples = {"client": process_stats(os.getpid())}
+            process = backend.process
+            if process.poll() is None:
+                samples["backend"] = process_stats(process.pid)
+            for name, stats in samples.items():
+                if stats is None:
+                    continue
+                if clock.elapsed() <= duration * WARMUP_FRACTION or name not in baselines:
+                    baselines[name] = stats
+                peaks[name] = tuple(max(pair) for pair in zip(peaks.get(name, stats), stats))
+        # The last sample can overshoot the duration, and the backend keeps calling upstream while
+        # everything shuts down, so check the calls made in the virtual time that actually passed
+        with fake.lock:
+            calls = Counter(fake.calls)
+        simulated = clock.elapsed()
+        core.stop_polling()
+    backend.stop()
+    shutil.rmtree(workspace, ignore_errors=True)
+    fake.shutdown()
+
+    return check_bounds(simulated, core.poll_interval, bursts, calls, fake.queue, outage, backend.restarts,
+                        engine.latency_summary(), baselines, peaks)
+
+
+def check_bounds(duration, poll_interval, bursts, calls, queued, outage, restarts, latency, baselines, peaks):
+    """Print the soak results and return the list of exceeded bounds."""
+    max_polls = duration / poll_interval
+    expected_refreshes = duration / (TOKEN_LIFETIME - 60) * CALL_SLACK + 3  # spotipy refreshes a minute before expiry
+    # Each token expiry may cost the client one rejected call and its retry
+    # Each volume change reads the player state, then sets the volume; the engine can only merge them
+    volume_changes = bursts * (BURST_PRESSES + HOLD_SECONDS * VOLUME_STEPS_PER_SECOND + 1)
+    checks = [
+        ("upstream /me/player calls", calls["player"], max_polls * CALL_SLACK + bursts * BURST_PRESSES + volume_changes + expected_refreshes),
+        ("upstream volume calls", calls["volume"], volume_changes + expected_refreshes),
+        # The backend refreshes devices on its own timer; listing and cycling them must not add calls
+        ("upstream device list calls", calls["devices"], duration / BACKEND_DEVICE_REFRESH * CALL_SLACK + 3),
+        ("upstream transfer calls", calls["transfer"], bursts),
+        # Every rate-limited queue call is retried once
+        ("upstream queue calls", calls["queue"], bursts * ALBUM_TRACKS * (1 + 1 / (RATE_LIMIT_EVERY - 1)) + 1),
+        ("queue calls inside Retry-After", calls["queue_before_retry_after"], 0),
+        ("token refreshes", calls["token_refresh"], expected_refreshes),
+        ("unauthorized upstream calls", calls["unauthorized"], expected_refreshes),
+        ("backend restarts", restarts, 1),
+        ("hotkey dispatch p95 (ms)", latency["p95"] if latency else float("inf"), MAX_DISPATCH_P95_MS),
+    ]
+    for name in sorted(peaks):
+        rss, threads, sockets = peaks[name]
+        base_rss, base_threads, base_sockets = baselines[name]
+        checks += [
+            (f"{name} RSS (MiB)", rss / 2**20, (base_rss + MAX_RSS_GROWTH) / 2**20),
+            (f"{name} threads", threads, base_threads + MAX_THREAD_GROWTH),
+            (f"{name} open sockets", sockets, base_sockets + MAX_SOCKET_GROWTH),
+        ]
+    if not peaks:
+        print("Process stats are unavailable on this platform (install psutil); skipping resource bounds.")
+
+    failures = []
+    print(f"\n{'check':34s} {'observed':>10s} {'bound':>10s}")
+    for name, observed, bound in checks:
+        ok = observed <= bound
+        print(f"{name:34s} {observed:10.0f} {bound:10.0f}  {'ok' if ok else 'EXCEEDED'}")
+        if not ok:
+            failures.append(name)
+
+    all_queued = len(queued) == bursts * ALBUM_TRACKS
+    print(f"{'bulk-queued tracks':34s} {len(queued):10d} {bursts * ALBUM_TRACKS:10d}  {'ok' if all_queued else 'MISSING'}")
+    if not all_queued:
+        failures.append("bulk-queued tracks")
+    in_order = queued == [f"spotify:track:soak{index}" for index in range(ALBUM_TRACKS)] * bursts
+    print(f"{'bulk-queued tracks in album order':34s} {'yes' if in_order else 'no':>10s}")
+    if not in_order:
+        failures.append("bulk-queued tracks in album order")
+
+    # The outage is half way through, so polling after it should make about as many calls as before it;
+    # the few reads volume changes make can't account for half of them
+    resumed = restarts >= 1 and calls["player"] - outage["player_calls"] >= outage["player_calls"] / 2
+    print(f"{'polling resumed after outage':34s} {'yes' if resumed else 'no':>10s}")
+    if not resumed:
+        failures.append("polling resumed after outage")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak the controller core and backend against a fake Spotify API.")
+    parser.add_argument("--hours", type=float, default=24, help="virtual hours to simulate")
+    parser.add_argument("--minutes", type=float, default=3, help="wall-clock minutes to spend")
+    parser.add_argument("--verbose", action="store_true", help="show client and backend output")
+    parser.add_argument("--serve-backend", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--speed", type=float, help=argparse.SUPPRESS)
+    parser.add_argument("--real-start", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_backend:
+        serve_backend(args.serve_backend, args.speed, args.real_start)
+        return
+
+    failures = run_soak(args.hours, args.minutes, args.verbose)
+    if failures:
+        print(f"\nSoak failed: {', '.join(failures)}.")
+        sys.exit(1)
+    print("\nSoak passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Token cache for the backend's SpotifyOAuth.
+
+Token material lives in memory, so the reads on every request never touch the disk.
+Changes are written to the cache file in the background shortly afterwards, replacing
+the file atomically, so the next launch starts logged in. A new refresh token is written
+straight away, since losing it would mean logging in again.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+from spotipy.cache_handler import CacheHandler
+
+CACHE_PATH = ".cache"  # Same file spotipy's default handler uses, so existing logins carry over
+WRITE_DELAY = 1.0  # Seconds to wait after a change so bursts of refreshes cost one write
+
+
+class WriteBehindCacheHandler(CacheHandler):
+    """In-memory token cache that persists to cache_path off the request path."""
+    def __init__(self, cache_path=CACHE_PATH, write_delay=WRITE_DELAY):
+        self.cache_path = cache_path
+        self.write_delay = write_delay
+        self._lock = threading.Lock()  # Guards the in-memory token
+        self._write_lock = threading.Lock()  # Serialises file writes with clear()
+        self._token_info = self._load()
+        self._dirty = False
+        self._wake = threading.Event()
+        threading.Thread(target=self._write_loop, name="token-cache-writer", daemon=True).start()
+        atexit.register(self.flush)
+
+    def get_cached_token(self):
+        with self._lock:
+            return dict(self._token_info) if self._token_info else None
+
+    def save_token_to_cache(self, token_info):
+        with self._lock:
+            previous = self._token_info
+            self._token_info = dict(token_info)
+            self._dirty = True
+        if previous is None or previous.get("refresh_token") != token_info.get("refresh_token"):
+            self.flush()  # Spotify may have rotated the refresh token, so don't risk losing it
+        else:
+            self._wake.set()
+
+    def clear(self):
+        """Forget the token and delete the cache file. Returns True if there was a token."""
+        with self._write_lock:
+            with self._lock:
+                had_token = self._token_info is not None
+                self._token_info = None
+                self._dirty = False
+            try:
+                os.remove(self.cache_path)
+                had_token = True
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Error removing token cache: {e}")
+        return had_token
+
+    def flush(self):
+        """Write the token to the cache file now if it changed since the last write."""
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                token_info = self._token_info
+                self._dirty = False
+            # Write a temporary file and swap it in, so a crash never leaves a half-written cache
+            temp_path = f"{self.cache_path}.tmp"
+            try:
+                with open(temp_path, "w") as file:
+                    json.dump(token_info, file)
+                os.replace(temp_path, self.cache_path)
+            except OSError as e:
+                print(f"Error writing token cache: {e}")
+
+    def _load(self):
+        try:
+            with open(self.cache_path, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Error reading token cache: {e}")
+            return None
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.write_delay)
+            self._wake.clear()
+            self.flush()